@@ -0,0 +1,341 @@
+import gc
+import math
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import importlib.util
+
+# Everything runs on SDL's dummy drivers so no window or sound card is needed.
+os.environ.setdefault( "SDL_VIDEODRIVER", "dummy" )
+os.environ.setdefault( "SDL_AUDIODRIVER", "dummy" )
+
+import pygame
+
+HERE = os.path.dirname( os.path.abspath( __file__ ) )
+BASELINE = os.path.join( HERE, "benchmark-baseline.json" )
+THRESHOLD = 0.5
+ROUNDS = 3
+BATCH = 100
+
+TURNS = [ 10, 100, 1000, 10000 ]
+PARTICLES = [ 0, 1000, 10000 ]
+HISCORES = [ 10, 100, 1000 ]
+PLAYERS = [ 2, 4, 8 ]
+
+
+def load_game():
+    # oscar-tron.py isn't an importable module name, so load it by path.
+    os.chdir( HERE )
+    spec = importlib.util.spec_from_file_location( "oscar_tron", os.path.join( HERE, "oscar-tron.py" ) )
+    tron = importlib.util.module_from_spec( spec )
+    spec.loader.exec_module( tron )
+    return tron
+
+
+def measure( fn, repeat = 7, minimum = 0.05 ):
+    """Best time per call of fn in microseconds."""
+    # Like timeit, keep the collector from landing in one run and not another.
+    gc.collect()
+    gc.disable()
+    try:
+        return best_of( fn, repeat, minimum ) * 1e6
+    finally:
+        gc.enable()
+
+
+def best_of( fn, repeat, minimum ):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range( number ):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minimum:
+            break
+        number *= 2
+    best = elapsed / number
+    for r in range( repeat - 1 ):
+        start = time.perf_counter()
+        for i in range( number ):
+            fn()
+        best = min( best, ( time.perf_counter() - start ) / number )
+    return best
+
+
+def measure_each( fn, arg, batch = BATCH ):
+    """Time per call of fn( arg ) in microseconds, for calls too quick to
+    time one at a time: below a microsecond the timing loop's own cost
+    swamps the difference between runs."""
+    def calls():
+        for i in range( batch ):
+            fn( arg )
+    return measure( calls ) / batch
+
+
+def calibrate():
+    """Time for a fixed lump of plain Python. Results are compared after
+    scaling by it, so a run that caught the machine at a slow moment
+    doesn't look like a regression."""
+    def work():
+        total = 0.0
+        table = {}
+        for i in range( 2000 ):
+            total += math.sqrt( i ) * 0.5
+            table[ i & 63 ] = total
+        return total
+    return measure( work )
+
+
+def grow_trail( tron, player, turns, top, bottom, left, right ):
+    """Give player a zig-zag trail of turns corners between top and bottom,
+    then a path round to where it is now that comes in from behind."""
+    step = ( right - left ) / ( turns // 2 + 1 )
+    x, y = player.pos
+    back = -20 if player.vel[0] > 0 else 20
+    path = []
+    for i in range( turns // 2 ):
+        cx = left + i * step
+        if i % 2:
+            path += [ ( cx, bottom ), ( cx, top ) ]
+        else:
+            path += [ ( cx, top ), ( cx, bottom ) ]
+    lx = path[-1][0]
+    path += [ ( lx, y + back * 2 ), ( x + back, y + back * 2 ), ( x + back, y ), ( x, y ), ( x, y ) ]
+    player.path = tron.Path( path )
+
+
+def long_level( tron, turns, particles = 0, bots = () ):
+    level = tron.Level( tron.SCREEN_WIDTH, tron.SCREEN_HEIGHT, seed = 1, bots = bots )
+    for p, player in enumerate( level.players ):
+        top = 40 + p * 100
+        grow_trail( tron, player, turns, top, top + 80, 100, tron.SCREEN_WIDTH - 60 )
+    level.reindex()
+    level.free_space.redraw( [ player.path for player in level.players ] )
+    top_up( level, particles )
+    return level
+
+
+def top_up( level, particles ):
+    # Particles all cool off together after a few hundred ticks, so long
+    # runs start a fresh explosion to keep the count steady.
+    if len( level.particles ) < particles:
+        level.particles.emit( ( 500, 500 ), ( 0, 0 ), ( 230, 20, 20 ), particles - len( level.particles ), level.speed * 5, level.random )
+
+
+def bench_collision( tron, results ):
+    for turns in TURNS:
+        level = long_level( tron, turns )
+        player, opponent = level.players
+        player.pos[0] += 1
+        results[ "check_crash/%d" % turns ] = measure_each( tron.check_crash, player )
+        seg = ( player.pos, player.path[-1] )
+        results[ "collision/%d" % turns ] = measure( lambda: tron.collision( seg, opponent.path ) )
+        results[ "aa_collision/%d" % turns ] = measure( lambda: tron.aa_collision( seg, opponent.path ) )
+
+
+def ticker( tron, level, particles = 0 ):
+    """A function that runs one tick of level, starting from the same state
+    every time so players never wander into a wall and powerups don't
+    pile up."""
+    state = [ player.path[-1] for player in level.players ]
+    def update():
+        for player, last in zip( level.players, state ):
+            player.pos[0], player.pos[1] = last
+            player.path[-1] = last
+        level.powerup_timer = tron.POWER_UP_SPAWN
+        top_up( level, particles )
+        level.update( tron.SIM_TICK, tron.SCREEN_WIDTH, tron.SCREEN_HEIGHT )
+    return update
+
+
+def bench_players( tron, results ):
+    for count in PLAYERS:
+        level = tron.Level( tron.SCREEN_WIDTH, tron.SCREEN_HEIGHT, seed = 1, players = count )
+        results[ "level_update_players/%d" % count ] = measure( ticker( tron, level ) )
+
+
+def bench_input( tron, results ):
+    for count in PLAYERS:
+        joysticks = [ tron.ReplayJoystick( i ) for i in range( count ) ]
+        level = tron.Level( tron.SCREEN_WIDTH, tron.SCREEN_HEIGHT, joysticks, seed = 1, players = count )
+        # Along the way the last seat with keys is already going, so nobody
+        # turns and every call sees the same level.
+        player = [ player for player in level.players if player.keys is not tron.NO_KEYS ][-1]
+        key = pygame.event.Event( pygame.KEYDOWN, key = player.keys[ tron.Keys.RIGHT if player.vel[0] > 0 else tron.Keys.LEFT ] )
+        axis = pygame.event.Event( pygame.JOYAXISMOTION, instance_id = count - 1, axis = 1, value = 1.0 )
+        results[ "handle_key/%d" % count ] = measure_each( level.handle, key )
+        results[ "handle_axis/%d" % count ] = measure_each( level.handle, axis )
+
+
+def bench_bots( tron, results ):
+    for difficulty in sorted( tron.BOT_LEVELS ):
+        level = long_level( tron, 1000, bots = [ difficulty ] )
+        bot = level.bots[0]
+        occupancy = level.occupancy
+        # Timed without a deadline to see what a whole look would cost.
+        def rebuild():
+            occupancy.index = None
+            occupancy.sync( level )
+        rebuild()
+        ahead = occupancy.cell( *bot.player.pos ) + ( 1 if bot.player.vel[0] > 0 else -1 )
+        results[ "bot_room/%s" % difficulty ] = measure( lambda: bot.room( occupancy, ahead, float( "inf" ) ) )
+    results[ "bot_rebuild/1000" ] = measure( rebuild )
+
+
+def bench_level( tron, results ):
+    screen = pygame.display.get_surface()
+    canvas = tron.Canvas( screen )
+    for turns in TURNS:
+        for particles in PARTICLES:
+            level = long_level( tron, turns, particles )
+            results[ "level_update/%d/%d" % ( turns, particles ) ] = measure( ticker( tron, level, particles ) )
+            # However many ticks that took, the particles have moved on by
+            # them, so drawing starts again from where they began.
+            level = long_level( tron, turns, particles )
+
+            def draw():
+                canvas.begin()
+                level.draw( tron.SCREEN_WIDTH, tron.SCREEN_HEIGHT, canvas )
+                canvas.end()
+            draw()
+            results[ "level_draw/%d/%d" % ( turns, particles ) ] = measure( draw )
+            level.trails_dirty = True
+            results[ "level_redraw_trails/%d/%d" % ( turns, particles ) ] = measure( lambda: ( setattr( level, "trails_dirty", True ), draw() ) )
+
+
+def bench_text( tron, results, workdir ):
+    screen = pygame.display.get_surface()
+    canvas = tron.Canvas( screen )
+    results[ "write/cached" ] = measure( lambda: tron.write( canvas, 100, 700, "12345" ) )
+    counter = iter( range( 10 ** 9 ) )
+    results[ "write/uncached" ] = measure( lambda: tron.write( canvas, 100, 700, str( next( counter ) ) ) )
+
+    for players in HISCORES:
+        store = tron.HighscoreStore( os.path.join( workdir, "hiscores-%d.db" % players ), os.path.join( workdir, "none.json" ) )
+        store.record_all( [ [ ( "P%04d" % p, p * 10 ), ( "P%04d" % ( ( p + 1 ) % players ), 0 ) ] for p in range( players ) ] )
+        tron.highscores = store
+        screen_ = tron.HiscoreScreen()
+        def draw():
+            canvas.begin()
+            screen_.draw( tron.SCREEN_WIDTH, tron.SCREEN_HEIGHT, canvas )
+            canvas.end()
+        results[ "hiscore_draw/%d" % players ] = measure( draw )
+        results[ "hiscore_load/%d" % players ] = measure( lambda: ( setattr( store, "board", None ), tron.HiscoreScreen() ) )
+        store.close()
+
+
+def run_round():
+    """Every benchmark once, with the calibration either side of them."""
+    tron = load_game()
+    tron.init()
+    calibration = calibrate()
+    results = {}
+    bench_collision( tron, results )
+    bench_players( tron, results )
+    bench_input( tron, results )
+    bench_bots( tron, results )
+    pygame.display.set_mode( ( tron.SCREEN_WIDTH, tron.SCREEN_HEIGHT ) )
+    tron.load_assets()
+    bench_level( tron, results )
+    with tempfile.TemporaryDirectory() as workdir:
+        bench_text( tron, results, workdir )
+    return {
+        "meta": { "python": platform.python_version(), "pygame": pygame.version.ver,
+                  "machine": platform.machine(), "numpy": bool( tron.numpy ) },
+        "calibration": min( calibration, calibrate() ),
+        "results": results,
+    }
+
+
+def run( rounds = ROUNDS ):
+    """The best time of each benchmark over several rounds of them all,
+    each in a process of its own. Whatever else the machine is doing comes
+    and goes over seconds, which the repeats within one measure() are too
+    close together to get past, and the quickest calls come out faster or
+    slower with each interpreter's hash seed and memory layout."""
+    report = None
+    with tempfile.TemporaryDirectory() as workdir:
+        for r in range( rounds ):
+            filename = os.path.join( workdir, "round-%d.json" % r )
+            subprocess.run( [ sys.executable, os.path.abspath( __file__ ), "--round", filename ], check = True )
+            with open( filename, 'r' ) as f:
+                one = json.load( f )
+            if report is None:
+                report = one
+                continue
+            report["calibration"] = min( report["calibration"], one["calibration"] )
+            for name, us in one["results"].items():
+                report["results"][name] = min( report["results"].get( name, us ), us )
+    return report
+
+
+def mismatch( meta, baseline ):
+    """What differs between where the results and the baseline came from."""
+    return [ "%s %s, not %s" % ( key, meta.get( key ), baseline.get( key ) )
+             for key in sorted( set( meta ) | set( baseline ) ) if meta.get( key ) != baseline.get( key ) ]
+
+
+def compare( results, baseline, threshold, scale = 1.0 ):
+    """Names of benchmarks more than threshold slower than the baseline,
+    once it's scaled by how much slower the machine is running."""
+    slower = []
+    for name, us in results.items():
+        if name in baseline and us > baseline[name] * scale * ( 1 + threshold ):
+            slower.append( name )
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description = 'Tron benchmarks, times in microseconds per call.' )
+    parser.add_argument( '--output', help='write the results as JSON to this file')
+    parser.add_argument( '--baseline', default=BASELINE, help='baseline results to compare with')
+    parser.add_argument( '--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument( '--threshold', type=float, default=THRESHOLD, help='fraction slower than baseline that counts as a regression')
+    parser.add_argument( '--rounds', type=int, default=ROUNDS, help='times to run every benchmark, keeping the best')
+    parser.add_argument( '--round', metavar='FILE', help=argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.round:
+        # One of run()'s rounds, in a process of its own.
+        with open( args.round, 'w' ) as f:
+            json.dump( run_round(), f )
+        sys.exit( 0 )
+
+    report = run( args.rounds )
+    results = report["results"]
+
+    recorded = { "meta": {}, "results": {} }
+    if os.path.exists( args.baseline ):
+        with open( args.baseline, 'r' ) as f:
+            recorded = json.load( f )
+    baseline = recorded["results"]
+    # A baseline from before calibration was kept is taken as it stands.
+    scale = report["calibration"] / recorded.get( "calibration", report["calibration"] )
+
+    for name, us in results.items():
+        change = ""
+        if name in baseline:
+            change = "%+6.1f%%" % ( ( us / ( baseline[name] * scale ) - 1 ) * 100 )
+        print( "%-36s %12.2f us %s" % ( name, us, change ) )
+    print( "Machine running at %.2fx the speed it was for the baseline" % ( 1 / scale ) )
+
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            json.dump( report, f, indent = 1 )
+
+    if args.save_baseline:
+        with open( args.baseline, 'w' ) as f:
+            json.dump( report, f, indent = 1 )
+    elif baseline and mismatch( report["meta"], recorded["meta"] ):
+        # Timings from another build or machine say nothing about this change.
+        print( "Not comparing, the baseline was recorded elsewhere: %s" % "; ".join( mismatch( report["meta"], recorded["meta"] ) ) )
+    else:
+        slower = compare( results, baseline, args.threshold, scale )
+        if slower:
+            print( "Slower than baseline by more than %d%%: %s" % ( args.threshold * 100, ", ".join( slower ) ) )
+            sys.exit( 1 )
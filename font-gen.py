@@ -1,25 +1,115 @@
+import os
 import sys
+import json
+import hashlib
+import argparse
 import pygame
 
-pygame.init ()
+# Bump when the atlas layout changes, so old atlases get rebuilt.
+FORMAT = 1
+FIRST = 32
+LAST = 126
+WIDTH = 512
+PADDING = 1
 
-if len (sys.argv) < 4  or sys.argv[3] == sys.argv[1]:
-    print( "usage: %s fontfile size bitmapfile" % sys.argv[0] )
-    sys.exit ()
+# Text runs up the screen in the game, "up" glyphs are turned a quarter
+# turn anticlockwise to suit. "across" glyphs read left to right, for a
+# rotated cabinet.
+ORIENTATIONS = { "up": 90, "across": 0 }
 
-filename = sys.argv[1]
-size = int(sys.argv[2])
-outname = sys.argv[3]
 
-font = pygame.font.Font (filename, size)
+def source_hash( filename, sizes ):
+    """Hash of the font and everything else that goes into the atlas."""
+    digest = hashlib.sha256()
+    with open( filename, 'rb' ) as f:
+        digest.update( f.read() )
+    digest.update( json.dumps( [ FORMAT, FIRST, LAST, WIDTH, PADDING, sorted( ORIENTATIONS.items() ), sorted( sizes ) ] ).encode() )
+    return digest.hexdigest()
 
-surface = pygame.Surface( (10 * size, 10 * size), depth=32)
-surface.fill ((0, 0, 0))
 
-for i in range( 32, 127 ):
-    sf = font.render (chr(i), True, (255, 255, 255))
-    x = (i - 32) % 10
-    y = (i - 32) // 10
-    surface.blit (sf, (x * size, y * size))
-pygame.image.save (surface, outname)
+def up_to_date( outname, digest ):
+    try:
+        with open( outname + ".json", 'r' ) as f:
+            metrics = json.load( f )
+    except ( OSError, ValueError ):
+        return False
+    return metrics.get( "hash" ) == digest and os.path.exists( metrics.get( "texture", "" ) )
 
+
+def glyphs( font, size ):
+    """Each character cropped to its size by size cell, as it would be
+    drawn at the top left of the cell, then to the pixels it lights.
+    Yields the character, its orientation, the cropped surface and where
+    that sits in the cell."""
+    for i in range( FIRST, LAST + 1 ):
+        cell = pygame.Surface( ( size, size ), depth = 32 )
+        cell.fill( ( 0, 0, 0 ) )
+        cell.blit( font.render( chr(i), True, ( 255, 255, 255 ) ), ( 0, 0 ) )
+        for orientation, angle in ORIENTATIONS.items():
+            turned = pygame.transform.rotate( cell, angle )
+            turned.set_colorkey( ( 0, 0, 0 ) )
+            box = turned.get_bounding_rect()
+            turned.set_colorkey( None )
+            yield chr(i), orientation, turned.subsurface( box ).copy(), box.x, box.y
+
+
+def pack( items ):
+    """Shelf pack surfaces into WIDTH columns, tallest first. Returns the
+    height needed and the x, y of each item."""
+    order = sorted( range( len( items ) ), key = lambda i: -items[i].get_height() )
+    places = [ None ] * len( items )
+    x = y = shelf = 0
+    for i in order:
+        w, h = items[i].get_size()
+        if x + w > WIDTH:
+            x, y = 0, y + shelf + PADDING
+            shelf = 0
+        places[i] = ( x, y )
+        x += w + PADDING
+        shelf = max( shelf, h )
+    return y + shelf, places
+
+
+def build( filename, sizes, outname ):
+    entries = []
+    for size in sizes:
+        font = pygame.font.Font( filename, size )
+        for char, orientation, surface, dx, dy in glyphs( font, size ):
+            entries.append( ( size, orientation, char, surface, dx, dy ) )
+
+    height, places = pack( [ entry[3] for entry in entries ] )
+
+    # The glyphs are white on black, so a grey palette holds them in a
+    # quarter of the space.
+    atlas = pygame.Surface( ( WIDTH, max( height, 1 ) ), depth = 8 )
+    atlas.set_palette( [ ( i, i, i ) for i in range( 256 ) ] )
+    atlas.fill( 0 )
+    metrics = { "format": FORMAT, "texture": outname + ".bmp", "sizes": {} }
+    for ( size, orientation, char, surface, dx, dy ), ( x, y ) in zip( entries, places ):
+        atlas.blit( surface, ( x, y ) )
+        table = metrics["sizes"].setdefault( str( size ), { "cell": size } ).setdefault( orientation, {} )
+        table[char] = [ x, y, surface.get_width(), surface.get_height(), dx, dy ]
+
+    pygame.image.save( atlas, metrics["texture"] )
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description = 'Build the font atlas the game writes with.' )
+    parser.add_argument( 'fontfile' )
+    parser.add_argument( '--sizes', type=int, nargs='+', default=[ 50 ], help='cell sizes to render the font at')
+    parser.add_argument( '--output', default='font-atlas', help='writes OUTPUT.bmp and OUTPUT.json')
+    parser.add_argument( '--force', action='store_true', help='build even if nothing has changed')
+    args = parser.parse_args()
+
+    digest = source_hash( args.fontfile, args.sizes )
+    if not args.force and up_to_date( args.output, digest ):
+        print( "%s is up to date" % args.output )
+        sys.exit()
+
+    pygame.init()
+    metrics = build( args.fontfile, args.sizes, args.output )
+    metrics["hash"] = digest
+    with open( args.output + ".json", 'w' ) as f:
+        json.dump( metrics, f, indent = 1 )
+    print( "wrote %s and %s.json" % ( metrics["texture"], args.output ) )
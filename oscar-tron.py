@@ -1,4 +1,9 @@
 import sys
+import time
+
+# Taken before pygame is imported, for --profile-startup.
+STARTED = time.perf_counter()
+
 import pygame
 import enum
 import argparse
@@ -6,6 +11,24 @@ import random
 import math
 import json
 import collections
+import sqlite3
+import threading
+import queue
+import struct
+import array
+import socket
+import select
+import heapq
+import os
+import io
+import re
+import hashlib
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 SCREEN_WIDTH = 1152
 SCREEN_HEIGHT = 864
@@ -25,37 +48,846 @@ POWER_UP_MARGIN = 30
 POWER_UP_SPAWN = 5000
 POWER_UP_TIME = 15000
 COIN_SCORE = 100
+GRID_CELL = 64
+FREE_CELL = 10
+TEXT_CACHE_SIZE = 256
+EXPLOSION_PARTICLES = 200
+SPARKLE = 100
+DIRTY_FLIP = 0.5
+WRITE_QUEUE_SIZE = 64
+PROFILE_WINDOW = 600
+PROFILE_HUD_MS = 500
+PROFILE_PHASES = [ "total", "handle", "update", "collision", "spawn", "particles", "draw", "trails", "text", "flip", "bots" ]
+
+SIM_TICK = 1000 / 120
+SIM_MAX_TICKS = 120 * 60 * 10
+MAX_FRAME_TIME = 250
+FRAME_RATE = 60
+FRAME_SPIN = 1.0
+VSYNC_HEADROOM = 1.1
+IDLE_WAKE = 250
+SCORE_ROWS = 4
+RECORD_BUFFER = 1 << 16
+BOT_CELL = 8
+BOT_NAME = "CPU"
+BOT_FRAME_BUDGET = 2.0
+NET_DELAY = 6
+NET_WINDOW = 64
+NET_PACKET = 512
+NET_HELLO_TICKS = 30
+NET_TURN = 7
+NET_PRESS = 8
+NET_RELEASE = 16
+NET_CHECK_TICKS = 120
+
+# How well bots play: ticks between looks, cells looked ahead, cells of
+# room counted past each way it could go and ms allowed per look.
+BOT_LEVELS = {
+    "easy": ( 12, 3, 40, 0.25 ),
+    "normal": ( 4, 6, 400, 1.0 ),
+    "hard": ( 1, 12, 2000, 2.0 ),
+}
+
+# Every image the game draws: name, file, colorkey, per-pixel alpha. The
+# font is the atlas font-gen.py built, or the old bitmap without one.
+FONT_ATLAS = "font-atlas.json"
+FONT_BITMAP = "reduction-rotated.bmp"
+ASSETS = [
+    ( "logo", "oscar-tron-rotated.bmp", None, False ),
+    ( "boost", "boost.bmp", None, False ),
+    ( "brakes", "brakes.bmp", None, False ),
+    ( "clear", "clear.bmp", None, False ),
+    ( "coin", "coin.bmp", None, False ),
+]
+
+# The same images drawn straight from their SVG sources at the size the
+# game draws them: name, file, width and height, quarter turns
+# anticlockwise to stand them up the way text runs. See sprite_atlas; the
+# bitmaps above are only loaded where SVGs can't be drawn.
+SPRITES = [
+    ( "logo", "oscar-tron.svg", ( 500, 101 ), 1 ),
+    ( "boost", "boost.svg", ( POWER_UP_SIZE, POWER_UP_SIZE ), 0 ),
+    ( "brakes", "brakes.svg", ( POWER_UP_SIZE, POWER_UP_SIZE ), 0 ),
+    ( "clear", "clear.svg", ( POWER_UP_SIZE, POWER_UP_SIZE ), 0 ),
+    ( "coin", "coin.svg", ( POWER_UP_SIZE, POWER_UP_SIZE ), 0 ),
+]
+SPRITE_CACHE = ".sprite-cache"
+SPRITE_FORMAT = 1
+SPRITE_ATLAS_WIDTH = 512
+
+# Everyone who can play: name, colour and keys in Keys order. The last few
+# seats are only reachable with joysticks.
+NO_KEYS = [ None ] * 5
+PLAYERS = [
+    ( "RED", (230,20,20), [ pygame.K_a, pygame.K_d, pygame.K_w, pygame.K_s, pygame.K_c ] ),
+    ( "BLUE", (20,20,230), [ pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_SPACE ] ),
+    ( "GREEN", (20,200,20), [ pygame.K_j, pygame.K_l, pygame.K_i, pygame.K_k, pygame.K_m ] ),
+    ( "ORANGE", (240,140,0), [ pygame.K_KP4, pygame.K_KP6, pygame.K_KP8, pygame.K_KP5, pygame.K_KP0 ] ),
+    ( "PURPLE", (160,40,220), NO_KEYS ),
+    ( "CYAN", (20,210,210), NO_KEYS ),
+    ( "PINK", (240,80,180), NO_KEYS ),
+    ( "LIME", (150,230,40), NO_KEYS ),
+]
+
+# Set up by init() and load_assets(), which the headless simulation never calls.
+joysticks = []
+text_renderer = None
+# Difficulty of each bot in a live match, from the command line.
+bots = []
+
+class HighscoreStore():
+
+    """Highscores kept in an SQLite database, starting from highscores.json."""
+
+    # pairs is each player's latest score against each line-up of opponents,
+    # their names joined with +, and totals the sum of those per player.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS matches ( id INTEGER PRIMARY KEY, time REAL, players TEXT );
+        CREATE TABLE IF NOT EXISTS pairs ( player TEXT, opponent TEXT, score INTEGER, PRIMARY KEY ( player, opponent ) );
+        CREATE TABLE IF NOT EXISTS totals ( player TEXT PRIMARY KEY, score INTEGER );
+        CREATE TABLE IF NOT EXISTS meta ( key TEXT PRIMARY KEY, value TEXT );
+    """
+
+    def __init__( self, filename = 'highscores.db', legacy = 'highscores.json' ):
+        self.filename = filename
+        self.legacy = legacy
+        self.db = None
+        self.lock = threading.Lock()
+        self.board = None
+        self.version = 0
+
+    def open( self ):
+        if self.db is None:
+            self.db = sqlite3.connect( self.filename, check_same_thread = False )
+            self.db.executescript( self.SCHEMA )
+            self.import_legacy()
+        return self.db
+
+    def close( self ):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def import_legacy( self ):
+        if self.db.execute( "SELECT 1 FROM meta WHERE key = 'imported'" ).fetchone():
+            return
+        try:
+            with open( self.legacy, 'r' ) as f:
+                legacy = json.load( f )
+        except FileNotFoundError:
+            legacy = {}
+        with self.db:
+            for player, data in legacy.items():
+                for opponent, score in data.items():
+                    self.set_pair( player, opponent, score )
+            self.db.execute( "INSERT INTO meta VALUES ( 'imported', ? )", ( self.legacy, ) )
+
+    def set_pair( self, player, opponent, score ):
+        score = round( score )
+        old = self.db.execute( "SELECT score FROM pairs WHERE player = ? AND opponent = ?", ( player, opponent ) ).fetchone()
+        self.db.execute( "INSERT OR REPLACE INTO pairs VALUES ( ?, ?, ? )", ( player, opponent, score ) )
+        self.db.execute( "INSERT OR IGNORE INTO totals VALUES ( ?, 0 )", ( player, ) )
+        self.db.execute( "UPDATE totals SET score = score + ? WHERE player = ?", ( score - ( old[0] if old else 0 ), player ) )
+
+    def record( self, scores ):
+        """Save a match, scores being ( name, score ) for each seat in order."""
+        self.record_all( [ scores ] )
+
+    def record_all( self, matches ):
+        """Save several matches in one transaction."""
+        with self.lock:
+            db = self.open()
+            with db:
+                for scores in matches:
+                    db.execute( "INSERT INTO matches ( time, players ) VALUES ( ?, ? )", ( time.time(), json.dumps( scores ) ) )
+                    for p, ( name, score ) in enumerate( scores ):
+                        others = "+".join( other for q, ( other, s ) in enumerate( scores ) if q != p )
+                        self.set_pair( name, others, score )
+            # Read again here on the writer's thread, so the screens never
+            # wait on the database.
+            self.board = self.query()
+            self.version += 1
+
+    def query( self ):
+        return self.open().execute( "SELECT player, score FROM totals ORDER BY score DESC" ).fetchall()
+
+    def leaderboard( self ):
+        """( name, total ) for every player, best first."""
+        if self.board is None:
+            with self.lock:
+                # It may have been loaded while this waited for the lock.
+                if self.board is None:
+                    self.board = self.query()
+        return self.board
+
+highscores = HighscoreStore()
+
+
+class BackgroundWriter():
+
+    """Runs saves on a worker thread so the game loop never waits on the disk.
+
+    submit() queues an item for a handler; the queue is bounded, so a
+    stalled disk eventually holds the game up rather than eating memory.
+    The worker takes everything that is waiting at once and hands each
+    handler all of its items in a single call, so a burst costs one write.
+    close() waits for everything queued so far and stops the worker."""
+
+    def __init__( self, size = WRITE_QUEUE_SIZE ):
+        self.queue = queue.Queue( size )
+        self.thread = None
+
+    def submit( self, handler, item ):
+        if self.thread is None:
+            self.thread = threading.Thread( target = self.run, name = "writer", daemon = True )
+            self.thread.start()
+        self.queue.put( ( handler, item ) )
+
+    def run( self ):
+        running = True
+        while running:
+            jobs = [ self.queue.get() ]
+            while True:
+                try:
+                    jobs.append( self.queue.get_nowait() )
+                except queue.Empty:
+                    break
 
-pygame.init()
+            batches = {}
+            for job in jobs:
+                if job is None:
+                    running = False
+                else:
+                    batches.setdefault( job[0], [] ).append( job[1] )
+            for handler, items in batches.items():
+                try:
+                    handler( items )
+                except Exception as e:
+                    print( "Save failed:", e, file = sys.stderr )
+
+    def close( self ):
+        if self.thread is not None:
+            self.queue.put( None )
+            self.thread.join()
+            self.thread = None
+
+writer = BackgroundWriter()
+
+class TextRenderer():
+    """Draws strings from the font atlas.
+
+    The atlas is built by font-gen.py, which packs ASCII 32-126 at a few
+    sizes, both turned so text runs up the screen ("up") and upright
+    ("across"), and indexes where each glyph is and where it goes in its
+    FONT_SIZE cell. Without an index the atlas is the old hand rotated
+    bitmap: a 10x10 grid of up cells. Glyphs are sliced out once, and whole
+    strings are rendered onto their own surface and kept in a least
+    recently used cache keyed by text and angle.
+    """
+
+    def __init__( self, atlas, metrics = None, size = TEXT_CACHE_SIZE ):
+        self.atlas = atlas
+        self.size = size
+        self.cache = collections.OrderedDict()
+        self.glyphs = {}
+        if metrics:
+            for orientation, table in metrics["sizes"][ str( FONT_SIZE ) ].items():
+                if orientation != "cell":
+                    self.glyphs[orientation] = { letter : ( atlas.subsurface( (x, y, w, h) ), ( dx, dy ) )
+                                                 for letter, ( x, y, w, h, dx, dy ) in table.items() }
+        else:
+            self.glyphs["up"] = {}
+            for i in range( 0, 127 - 32 ):
+                a = (i // 10 * FONT_SIZE)
+                b = atlas.get_height() - (i % 10 * FONT_SIZE) - FONT_SIZE
+                self.glyphs["up"][ chr( i + 32 ) ] = ( atlas.subsurface( (a, b, FONT_SIZE, FONT_SIZE) ), ( 0, 0 ) )
+
+    def render( self, text, angle = 0 ):
+        key = ( text, angle )
+        rendered = self.cache.get( key )
+        if rendered is not None:
+            self.cache.move_to_end( key )
+            return rendered
+
+        if angle == -90 and "across" in self.glyphs:
+            # Text turned to read across the screen, put together from
+            # upright glyphs rather than turned afterwards.
+            rendered = pygame.Surface( ( len(text) * FONT_SIZE, FONT_SIZE ), 0, self.atlas )
+            rendered.fill(BLACK)
+            for l, letter in enumerate( text ):
+                glyph = self.glyphs["across"].get( letter )
+                if glyph:
+                    image, ( dx, dy ) = glyph
+                    rendered.blit( image, (l * FONT_SIZE + dx, dy) )
+        else:
+            # The first letter goes at the bottom.
+            rendered = pygame.Surface( ( FONT_SIZE, len(text) * FONT_SIZE ), 0, self.atlas )
+            rendered.fill(BLACK)
+            for l, letter in enumerate( text ):
+                glyph = self.glyphs["up"].get( letter )
+                if glyph:
+                    image, ( dx, dy ) = glyph
+                    rendered.blit( image, (dx, (len(text) - 1 - l) * FONT_SIZE + dy) )
+            if angle:
+                rendered = pygame.transform.rotate( rendered, angle )
+
+        self.cache[key] = rendered
+        if len( self.cache ) > self.size:
+            self.cache.popitem( last = False )
+        return rendered
+
+class Assets():
+
+    """Shared images, each loaded from disk once.
+
+    Once a display mode is set images are converted to its pixel format so
+    blitting them doesn't convert every time. Load time and memory use are
+    kept per image for report()."""
 
-pygame.mouse.set_visible(False) 
+    def __init__( self ):
+        self.images = {}
+        self.turned = {}
+        self.stats = {}
+        self.ready = {}
+
+    def __getitem__( self, name ):
+        return self.images[name]
+
+    def get( self, name, angle = 0 ):
+        """The named image turned by angle, turning it only the first time."""
+        if not angle:
+            return self.images[name]
+        key = ( name, angle )
+        if key not in self.turned:
+            self.turned[key] = pygame.transform.rotate( self.images[name], angle )
+        return self.turned[key]
+
+    def load_atlas( self, filename, rects ):
+        """Load an image packed with others, each name in rects getting
+        its x, y, width, height of it."""
+        atlas = self.load( "atlas", filename )
+        # report() lists each image, with its share of the load time.
+        filename, ms, size = self.stats.pop( "atlas" )
+        area = atlas.get_width() * atlas.get_height()
+        for name, rect in rects.items():
+            self.images[name] = atlas.subsurface( rect )
+            w, h = rect[2:]
+            self.stats[name] = ( filename, ms * w * h / area, w * h * atlas.get_bytesize() )
+
+    def prefetch( self, filenames ):
+        """Read image files ahead of load(), which only has to convert
+        them. Safe to run on another thread while the display is set up."""
+        for filename in filenames:
+            try:
+                self.ready[filename] = pygame.image.load( filename )
+            except ( OSError, pygame.error ):
+                pass
+
+    def load( self, name, filename, colorkey = None, alpha = False ):
+        start = time.perf_counter()
+        image = self.ready.pop( filename, None ) or pygame.image.load( filename )
+        if pygame.display.get_surface():
+            image = image.convert_alpha() if alpha else image.convert()
+        if colorkey is not None:
+            image.set_colorkey( colorkey, pygame.RLEACCEL )
+        self.images[name] = image
+        self.stats[name] = ( filename, ( time.perf_counter() - start ) * 1000, image.get_pitch() * image.get_height() )
+        return image
+
+    def report( self ):
+        lines = []
+        for name, ( filename, ms, size ) in self.stats.items():
+            lines.append( "%-8s %-24s %7.2f ms %8d bytes" % ( name, filename, ms, size ) )
+        lines.append( "%-33s %7.2f ms %8d bytes" % ( "total", sum( stat[1] for stat in self.stats.values() ),
+                                                      sum( stat[2] for stat in self.stats.values() ) ) )
+        return lines
+
+assets = Assets()
+
+def init():
+    """Bring up the display and the joysticks. Nothing else pygame has is
+    used, and opening a sound card for no reason can take a while."""
+    global joysticks
+
+    pygame.display.init()
+
+    pygame.mouse.set_visible(False) 
+
+    pygame.joystick.init()
+
+    joysticks = [pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count()) ]
+
+def rasterize( filename, size ):
+    """An SVG drawn at width, height size whatever size the file gives,
+    opaque on black like the bitmaps."""
+    with open( filename, 'rb' ) as f:
+        data = f.read()
+    width, height = size
+    data = re.sub( rb'(<svg\b[^>]*?\s)width="[^"]*"', rb'\g<1>width="%d"' % width, data, count = 1 )
+    data = re.sub( rb'(<svg\b[^>]*?\s)height="[^"]*"', rb'\g<1>height="%d"' % height, data, count = 1 )
+    image = pygame.image.load( io.BytesIO( data ), filename )
+    flat = pygame.Surface( image.get_size() )
+    flat.fill( BLACK )
+    flat.blit( image, ( 0, 0 ) )
+    return flat
+
+def sprite_files():
+    """The cached atlas and index for SPRITES as they are now. They are
+    named after a hash of the sources and the sizes they're drawn at, so
+    editing either builds a new atlas."""
+    digest = hashlib.sha256( repr( ( SPRITE_FORMAT, SPRITE_ATLAS_WIDTH, SPRITES ) ).encode() )
+    for name, filename, size, turns in SPRITES:
+        with open( filename, 'rb' ) as f:
+            digest.update( f.read() )
+    stem = os.path.join( SPRITE_CACHE, "sprites-" + digest.hexdigest()[:16] )
+    return stem + ".bmp", stem + ".json"
+
+def build_sprites( texture, index ):
+    """Draw SPRITES, shelf pack them tallest first into one image and save
+    it to texture, with where each one went in index."""
+    images = { name : pygame.transform.rotate( rasterize( filename, size ), 90 * turns )
+               for name, filename, size, turns in SPRITES }
+
+    rects = {}
+    x = y = shelf = right = 0
+    for name in sorted( images, key = lambda name: -images[name].get_height() ):
+        w, h = images[name].get_size()
+        if x and x + w > SPRITE_ATLAS_WIDTH:
+            x, y = 0, y + shelf + 1
+            shelf = 0
+        rects[name] = ( x, y, w, h )
+        x += w + 1
+        shelf = max( shelf, h )
+        right = max( right, x - 1 )
+
+    atlas = pygame.Surface( ( right, y + shelf ) )
+    atlas.fill( BLACK )
+    for name, rect in rects.items():
+        atlas.blit( images[name], rect[:2] )
+
+    os.makedirs( SPRITE_CACHE, exist_ok = True )
+    for old in os.listdir( SPRITE_CACHE ):
+        if old.startswith( "sprites-" ):
+            os.remove( os.path.join( SPRITE_CACHE, old ) )
+    pygame.image.save( atlas, texture )
+    with open( index, 'w' ) as f:
+        json.dump( rects, f )
+    return rects
+
+def sprite_atlas():
+    """The cached atlas for SPRITES and where each one is in it, building
+    it first if there's none for the current sources. None if it can't be
+    built here."""
+    try:
+        texture, index = sprite_files()
+        try:
+            with open( index, 'r' ) as f:
+                rects = json.load( f )
+            # The index is no good without the image it indexes.
+            if not os.path.exists( texture ):
+                raise FileNotFoundError( texture )
+        except ( OSError, ValueError ):
+            rects = build_sprites( texture, index )
+    except ( OSError, pygame.error ) as e:
+        print( "Drawing the bitmaps, the sprite atlas can't be built:", e, file = sys.stderr )
+        return None
+    return texture, rects
+
+def font_atlas():
+    """The font atlas metrics, None if there's no usable atlas."""
+    try:
+        with open( FONT_ATLAS, 'r' ) as f:
+            metrics = json.load( f )
+        metrics["sizes"][ str( FONT_SIZE ) ]
+        return metrics
+    except ( OSError, ValueError, KeyError ):
+        return None
+
+def find_assets():
+    """Which files load_assets() will load. Needs no display, so it can
+    run alongside setting one up, reading the files ahead as it goes."""
+    sprites = sprite_atlas()
+    metrics = font_atlas()
+    files = [ sprites[0] ] if sprites else [ filename for name, filename, colorkey, alpha in ASSETS ]
+    files.append( metrics["texture"] if metrics else FONT_BITMAP )
+    assets.prefetch( files )
+    return sprites, metrics
+
+def load_assets( found = None ):
+    """Load every image, after the display mode is set so they can be converted."""
+    global text_renderer
+
+    sprites, metrics = found or find_assets()
+    if sprites:
+        assets.load_atlas( *sprites )
+    else:
+        for name, filename, colorkey, alpha in ASSETS:
+            assets.load( name, filename, colorkey, alpha )
+
+    try:
+        if metrics:
+            assets.load( "font", metrics["texture"] )
+    except ( OSError, pygame.error ):
+        metrics = None
+    if not metrics:
+        assets.load( "font", FONT_BITMAP )
+    text_renderer = TextRenderer( assets["font"], metrics )
 
-pygame.joystick.init()
+def write( surface, x, y, text, centered = False ):
+    with profiler.section( "text" ):
+        if centered:
+            y += len(text) * FONT_SIZE // 2
+        surface.blit( text_renderer.render( text, surface.angle ), (x, y - len(text) * FONT_SIZE) )
+
+def faded( col, alpha ):
+    """col as it looks drawn at alpha over black."""
+    return pygame.Color( col[0] * alpha // 255, col[1] * alpha // 255, col[2] * alpha // 255 )
+
+
+class Canvas():
+
+    """Draws onto a surface in game coordinates.
+
+    Here game coordinates are the surface's own. RotatedCanvas maps them
+    onto a screen turned a quarter turn clockwise, so rotated cabinets can
+    draw straight to the screen. Images handed to blit() have to be turned
+    by angle already, see Assets.get and TextRenderer.render.
+
+    The screen's canvas also keeps track of what each frame changes. Every
+    drawing call records the rect it touched, and the next frame starts by
+    putting the background (black, or a layer such as the trails) back
+    over those rects. end() then hands back just the rects to update on
+    the display."""
+
+    angle = 0
+
+    def __init__( self, surface, tracking = True ):
+        self.surface = surface
+        self.width, self.height = surface.get_size()
+        self.tracking = tracking
+        self.background = None
+        self.drawn = []
+        self.dirty = []
+        self.everything = True
+
+    def layer( self ):
+        """A blank off-screen canvas of the same shape."""
+        return type(self)( pygame.Surface( self.surface.get_size(), 0, self.surface ), False )
+
+    def point( self, p ):
+        return p
+
+    def points( self, points ):
+        # pygame reads a Path point by point through __getitem__, which is
+        # a lot slower than handing it a list.
+        return points if type( points ) is list else list( points )
+
+    def area( self, rect ):
+        return rect
+
+    def pixels( self, x, y ):
+        return x, y
+
+    def mark( self, rect ):
+        if self.tracking:
+            self.drawn.append( rect )
+            self.dirty.append( rect )
+        return rect
+
+    def begin( self ):
+        """Start a frame by putting back the background under last frame's drawing."""
+        erase = self.drawn
+        self.drawn = []
+        self.dirty = []
+        self.everything = False
+        for rect in erase:
+            self.restore( rect )
+
+    def end( self ):
+        """The rects to pass to pygame.display.update, or None when a flip is cheaper."""
+        if self.everything:
+            return None
+        if sum( rect.width * rect.height for rect in self.dirty ) > DIRTY_FLIP * self.width * self.height:
+            return None
+        return self.dirty
+
+    def restore( self, rect ):
+        """Put the background back over a rect of the screen."""
+        if self.background:
+            self.surface.blit( self.background.surface, rect, rect )
+        else:
+            self.surface.fill( BLACK, rect )
+        self.dirty.append( pygame.Rect( rect ) )
 
-joysticks = [pygame.joystick.Joystick(x) for x in range(pygame.joystick.get_count()) ]
+    def invalidate( self ):
+        """Put the whole background back and have the whole screen updated."""
+        if self.background:
+            self.surface.blit( self.background.surface, (0, 0) )
+        else:
+            self.surface.fill( BLACK )
+        self.drawn = []
+        self.everything = True
 
-font = pygame.image.load("reduction-rotated.bmp")
+    def set_background( self, layer ):
+        if layer is not self.background:
+            self.background = layer
+            self.invalidate()
 
-logo = pygame.image.load("oscar-tron-rotated.bmp")
+    def reset( self ):
+        self.background = None
+        self.invalidate()
 
-# highscores is a dict of dicts of scores
-# Player - Opponent - Score
+    def fill( self, col ):
+        return self.mark( self.surface.fill( col ) )
 
-try:
-    with open('highscores.json','r') as f:
-        highscores = json.load( f )
-except FileNotFoundError:
-    highscores = {}
+    def blit( self, image, pos ):
+        return self.mark( self.surface.blit( image, pos ) )
+
+    def line( self, col, a, b, width ):
+        return self.mark( pygame.draw.line( self.surface, col, self.point( a ), self.point( b ), width ) )
+
+    def lines( self, col, closed, points, width ):
+        return self.mark( pygame.draw.lines( self.surface, col, closed, self.points( points ), width ) )
+
+    def rect( self, col, rect ):
+        return self.mark( pygame.draw.rect( self.surface, col, self.area( rect ) ) )
+
+    def set_at( self, p, col ):
+        p = self.point( p )
+        self.surface.set_at( p, col )
+        return self.mark( pygame.Rect( p, (1, 1) ).clip( self.surface.get_rect() ) )
+
+    def set_pixels( self, x, y, col ):
+        """Set the pixels at numpy arrays x and y to the rows of col."""
+        x, y = self.pixels( x, y )
+        width, height = self.surface.get_size()
+        visible = ( x >= 0 ) & ( x < width ) & ( y >= 0 ) & ( y < height )
+        x = x[visible]
+        y = y[visible]
+        if not len( x ):
+            return None
+        pixels = pygame.surfarray.pixels3d( self.surface )
+        pixels[ x, y ] = col[visible]
+        del pixels
+        left = int( x.min() )
+        top = int( y.min() )
+        return self.mark( pygame.Rect( left, top, int( x.max() ) - left + 1, int( y.max() ) - top + 1 ) )
+
+
+class RotatedCanvas(Canvas):
+
+    angle = -90
+
+    def __init__( self, surface, tracking = True ):
+        Canvas.__init__( self, surface, tracking )
+        self.height, self.width = surface.get_size()
+
+    def point( self, p ):
+        return ( self.height - 1 - p[1], p[0] )
+
+    def points( self, points ):
+        h = self.height - 1
+        return [ ( h - p[1], p[0] ) for p in points ]
+
+    def area( self, rect ):
+        x, y, w, h = rect
+        return pygame.Rect( self.height - y - h, x, h, w )
+
+    def pixels( self, x, y ):
+        return self.height - 1 - y, x
+
+    def blit( self, image, pos ):
+        # image is already turned, so its height is its width in game coordinates.
+        return self.mark( self.surface.blit( image, ( self.height - pos[1] - image.get_width(), pos[0] ) ) )
+
+class Section():
+
+    """Times a block of code into the profiler."""
+
+    def __init__( self, profiler, name ):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__( self ):
+        self.start = time.perf_counter()
+
+    def __exit__( self, *exc ):
+        self.profiler.add( self.name, ( time.perf_counter() - self.start ) * 1000 )
+
+
+class NullSection():
+
+    def __enter__( self ):
+        pass
+
+    def __exit__( self, *exc ):
+        pass
+
+
+class NullProfiler():
+
+    """What runs when profiling is off: every section is the same do-nothing block."""
+
+    section_ = NullSection()
+
+    def section( self, name ):
+        return self.section_
+
+    def add( self, name, ms ):
+        pass
+
+    def end_frame( self ):
+        pass
+
+    def draw_hud( self, surface, width, height ):
+        pass
+
+    def close( self ):
+        pass
+
+
+class Profiler():
+
+    """Times the phases of every frame.
+
+    Each section() adds its time in ms to the current frame, several
+    entries under one name adding up. end_frame() files the frame away in a
+    rolling window of the last PROFILE_WINDOW frames, which the p50, p95 and
+    p99 figures come from, and appends it to the trace file if there is
+    one: CSV with a column for each of PROFILE_PHASES, or JSON lines when
+    the name ends in .json.
+
+    The on-screen figures are only worked out every PROFILE_HUD_MS so the
+    text doesn't change, and need rendering, every frame."""
+
+    def __init__( self, trace = None, hud = False ):
+        self.sections = {}
+        self.frame = {}
+        self.frames = 0
+        self.samples = collections.OrderedDict()
+        self.hud = hud
+        self.hud_lines = []
+        self.hud_time = 0
+        self.trace = open( trace, 'w', buffering = 1 << 16 ) if trace else None
+        self.json = bool( trace ) and trace.endswith( ".json" )
+        if self.trace and not self.json:
+            self.trace.write( ",".join( [ "frame" ] + PROFILE_PHASES ) + "\n" )
+
+    def section( self, name ):
+        if name not in self.sections:
+            self.sections[name] = Section( self, name )
+        return self.sections[name]
+
+    def add( self, name, ms ):
+        self.frame[name] = self.frame.get( name, 0 ) + ms
+
+    def end_frame( self ):
+        for name, ms in self.frame.items():
+            if name not in self.samples:
+                self.samples[name] = collections.deque( maxlen = PROFILE_WINDOW )
+            self.samples[name].append( ms )
+
+        if self.trace:
+            if self.json:
+                self.trace.write( json.dumps( { "frame": self.frames, **self.frame } ) + "\n" )
+            else:
+                self.trace.write( ",".join( [ str( self.frames ) ] + [ "%.3f" % self.frame.get( name, 0 ) for name in PROFILE_PHASES ] ) + "\n" )
+
+        self.frames += 1
+        self.frame = {}
+
+    def percentiles( self, name ):
+        ordered = sorted( self.samples[name] )
+        return [ ordered[ min( int( len( ordered ) * p ), len( ordered ) - 1 ) ] for p in ( 0.5, 0.95, 0.99 ) ]
+
+    def report( self ):
+        lines = []
+        for name in self.samples:
+            lines.append( "%-10s %7.2f %7.2f %7.2f" % ( name, *self.percentiles( name ) ) )
+        return lines
+
+    def draw_hud( self, surface, width, height ):
+        if not self.hud:
+            return
+        now = time.perf_counter() * 1000
+        if now - self.hud_time > PROFILE_HUD_MS:
+            self.hud_time = now
+            self.hud_lines = [ "%s %.1f %.1f %.1f" % ( name, *self.percentiles( name ) ) for name in ( "total", "update", "draw" ) if name in self.samples ]
+        for i, line in enumerate( self.hud_lines ):
+            write( surface, width - ( FONT_SIZE + MARGIN ) * ( len( self.hud_lines ) - i ), height - MARGIN, line )
+
+    def close( self ):
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+
+profiler = NullProfiler()
+
+
+class Task():
+
+    """fn run on a thread of its own. result() waits for it to finish and
+    returns what it returned, or raises what it raised."""
+
+    def __init__( self, name, fn ):
+        self.name = name
+        self.fn = fn
+        self.value = None
+        self.error = None
+        self.ms = 0
+        self.thread = threading.Thread( target = self.run, name = name, daemon = True )
+        self.thread.start()
+
+    def run( self ):
+        start = time.perf_counter()
+        try:
+            self.value = self.fn()
+        except Exception as e:
+            self.error = e
+        self.ms = ( time.perf_counter() - start ) * 1000
+
+    def result( self ):
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.value
+
+
+class StartupProfile():
+
+    """Time from STARTED to the first frame, by phase, for --profile-startup.
+
+    mark() ends the phase running on the main thread. Tasks run alongside
+    are listed with their own times; waiting for one counts towards the
+    phase that waited."""
+
+    def __init__( self, start = STARTED ):
+        self.start = start
+        self.last = start
+        self.phases = []
+
+    def mark( self, name ):
+        now = time.perf_counter()
+        self.phases.append( ( name, ( now - self.last ) * 1000 ) )
+        self.last = now
+
+    def report( self, tasks = () ):
+        lines = [ "%-16s %8.1f ms" % phase for phase in self.phases ]
+        lines += [ "  %-14s %8.1f ms alongside" % ( task.name, task.ms ) for task in tasks ]
+        lines.append( "%-16s %8.1f ms" % ( "to first frame", ( self.last - self.start ) * 1000 ) )
+        return lines
+
+
+def score_columns( count ):
+    return ( count + SCORE_ROWS - 1 ) // SCORE_ROWS
+
+def score_position( p, count, height ):
+    """Where player p of count writes their score, in columns of up to
+    SCORE_ROWS down the left edge."""
+    rows = min( count, SCORE_ROWS )
+    return MARGIN + p // rows * FONT_SIZE, height - MARGIN - p % rows * height // rows
 
-def write( surface, x, y, text, centered = False ):
-    if centered:
-        y += len(text) * FONT_SIZE // 2
-    for l in range(0,len(text)):
-        letter = text[l]
-        i = ord( letter ) - 32
-        a = (i // 10 * FONT_SIZE)
-        b = font.get_height() - (i % 10 * FONT_SIZE) - FONT_SIZE
-        surface.blit( font, (x, y-l*FONT_SIZE - FONT_SIZE), (a,b,FONT_SIZE,FONT_SIZE) )
 
 class Keys(enum.IntEnum):
     """The order the keys are stored."""
@@ -65,6 +897,123 @@ class Keys(enum.IntEnum):
     RIGHT = 3
     ACTIVATE = 4
 
+# What every joystick's controls do. The stick is turned a quarter turn
+# like the cabinet, so pushing it left turns down the screen: each axis
+# with what it does pushed either way.
+STICK_AXES = { 0: ( Keys.DOWN, Keys.UP ), 1: ( Keys.LEFT, Keys.RIGHT ) }
+STICK_BUTTONS = { 1: Keys.ACTIVATE }
+
+
+class Bindings():
+
+    """What every control does: the keys of each seat in Keys order, and
+    the axes and buttons of a joystick, the same for every joystick.
+
+    compile() turns them into a Controls for the players of one screen."""
+
+    def __init__( self, keys = None, axes = STICK_AXES, buttons = STICK_BUTTONS ):
+        self.keys = keys or [ seat for name, col, seat in PLAYERS ]
+        self.axes = axes
+        self.buttons = buttons
+
+    @classmethod
+    def load( cls, filename ):
+        """Bindings from a JSON file like
+
+            { "keys": { "RED": { "down": "a", "up": "d", "left": "w", "right": "s", "activate": "c" } },
+              "axes": { "0": [ "down", "up" ], "1": [ "left", "right" ] },
+              "buttons": { "1": "activate" } }
+
+        keys being pygame key names without the K_, or key codes. Anything
+        left out keeps its default."""
+        with open( filename, 'r' ) as f:
+            config = json.load( f )
+        names = [ name for name, col, seat in PLAYERS ]
+        keys = [ seat for name, col, seat in PLAYERS ]
+        try:
+            for name, actions in config.get( "keys", {} ).items():
+                seat = names.index( name )
+                keys[seat] = list( keys[seat] )
+                for action, key in actions.items():
+                    if not isinstance( key, int ):
+                        key = getattr( pygame, "K_" + key, None )
+                        if key is None:
+                            raise KeyError( actions[action] )
+                    keys[seat][ Keys[ action.upper() ] ] = key
+            axes = { int( axis ) : tuple( Keys[ action.upper() ] for action in actions )
+                     for axis, actions in config.get( "axes", {} ).items() } or STICK_AXES
+            buttons = { int( button ) : Keys[ action.upper() ] for button, action in config.get( "buttons", {} ).items() } or STICK_BUTTONS
+        except ( KeyError, ValueError, TypeError ) as e:
+            raise ValueError( "bad binding in %s: %s" % ( filename, e ) )
+        return cls( keys, axes, buttons )
+
+    def compile( self, players ):
+        """Controls for players, by their keys and joysticks."""
+        return Controls( self, [ ( p, player.keys ) for p, player in enumerate( players ) ],
+                         { player.joystick.get_instance_id() : p for p, player in enumerate( players ) if player.joystick } )
+
+
+class Controls():
+
+    """Bindings compiled for one screen, from the event type and control
+    to ( player, action, pressed )."""
+
+    def __init__( self, bindings, seats, sticks ):
+        self.controls = {}
+        for p, keys in seats:
+            for action, key in enumerate( keys ):
+                if key is not None:
+                    self.controls[ ( pygame.KEYDOWN, key ) ] = ( p, Keys( action ), True )
+                    self.controls[ ( pygame.KEYUP, key ) ] = ( p, Keys( action ), False )
+        self.axes = {}
+        self.pressed = {}
+        for instance_id, p in sticks.items():
+            for button, action in bindings.buttons.items():
+                self.controls[ ( pygame.JOYBUTTONDOWN, instance_id, button ) ] = ( p, action, True )
+                self.controls[ ( pygame.JOYBUTTONUP, instance_id, button ) ] = ( p, action, False )
+            # The axes as the events left them, and what they press and
+            # let go of, made up front.
+            stick = { axis : 0.0 for axis in bindings.axes }
+            presses = { axis : ( ( p, negative, True ), ( p, positive, True ) ) for axis, ( negative, positive ) in bindings.axes.items() }
+            releases = { action : ( p, action, False ) for actions in bindings.axes.values() for action in actions }
+            for axis in bindings.axes:
+                self.axes[ ( instance_id, axis ) ] = ( stick, presses, releases )
+
+    def read( self, event ):
+        """( player, action, pressed ) for event, None if it's bound to nobody."""
+        kind = event.type
+        if kind == pygame.KEYDOWN or kind == pygame.KEYUP:
+            return self.controls.get( ( kind, event.key ) )
+        if kind == pygame.JOYBUTTONDOWN or kind == pygame.JOYBUTTONUP:
+            return self.controls.get( ( kind, event.instance_id, event.button ) )
+        if kind == pygame.JOYAXISMOTION:
+            return self.move( event )
+        return None
+
+    def move( self, event ):
+        # A stick presses a direction when one axis is past DEADZONE and
+        # the others aren't, and lets go when they are all back inside.
+        instance_id = event.instance_id
+        bound = self.axes.get( ( instance_id, event.axis ) )
+        if bound is None:
+            return None
+        stick, presses, releases = bound
+        stick[ event.axis ] = event.value
+        pushed = None
+        for axis, value in stick.items():
+            if value >= DEADZONE or value <= -DEADZONE:
+                if pushed is not None or value == DEADZONE or value == -DEADZONE:
+                    return None
+                pushed = presses[axis][ value > 0 ]
+        if pushed is None:
+            action = self.pressed.pop( instance_id, None )
+            return None if action is None else releases[action]
+        self.pressed[ instance_id ] = pushed[1]
+        return pushed
+
+
+bindings = Bindings()
+
 # function to check if point q lies on line segment 'pr'
 def on_segment(p, q, r):
     return (q[0] <= max(p[0], r[0]) and q[0] >= min(p[0], r[0]) and
@@ -127,6 +1076,65 @@ def collision( seg, path ):
     return False
 
 
+# Trails and the boundary only ever run horizontally or vertically, and two
+# such segments touch exactly when their bounding boxes overlap. The aa_
+# functions use that and fall back to intersect() for anything diagonal.
+
+def axis_aligned( a, b ):
+    return a[0] == b[0] or a[1] == b[1]
+
+def bounds( a, b ):
+    """x0, x1, y0, y1 of the segment ab."""
+    x0, x1 = ( a[0], b[0] ) if a[0] <= b[0] else ( b[0], a[0] )
+    y0, y1 = ( a[1], b[1] ) if a[1] <= b[1] else ( b[1], a[1] )
+    return x0, x1, y0, y1
+
+def overlap( a, b ):
+    """Do the x0, x1, y0, y1 boxes a and b overlap?"""
+    return a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]
+
+def aa_intersect( points ):
+    if not ( axis_aligned( *points[0] ) and axis_aligned( *points[1] ) ):
+        return intersect( points )
+    return overlap( bounds( *points[0] ), bounds( *points[1] ) )
+
+def aa_collision( seg, path ):
+    """Test seg against every segment of path in one pass."""
+    # The game asks SegmentIndex instead. This stays as the whole-path
+    # version of the same test, cross-checked below and benchmarked.
+    if not axis_aligned( *seg ):
+        return collision( seg, path )
+    x0, x1, y0, y1 = bounds( *seg )
+    for previous, current in zip( path, path[1:] ):
+        px, py = previous
+        cx, cy = current
+        if px != cx and py != cy:
+            if intersect( ( seg, (previous, current) ) ):
+                return True
+        elif ( ( px if px <= cx else cx ) <= x1 and x0 <= ( cx if px <= cx else px ) and
+               ( py if py <= cy else cy ) <= y1 and y0 <= ( cy if py <= cy else py ) ):
+            return True
+    return False
+
+def cross_check_intersect():
+    # Every horizontal and vertical segment on a small grid, including
+    # single points, against every other: crossings, T junctions, shared
+    # ends and collinear overlaps all have to agree with intersect().
+    points = [ (x, y) for x in range(0,3) for y in range(0,2) ]
+    segs = [ (a, b) for a in points for b in points if axis_aligned( a, b ) ]
+    for a in segs:
+        for b in segs:
+            if aa_intersect( (a, b) ) != intersect( (a, b) ):
+                return False
+            if aa_collision( a, b ) != collision( a, b ):
+                return False
+    return True
+
+assert cross_check_intersect()
+assert aa_intersect( ( ((0,0),(2,2)), ((0,2),(2,0)) ) ) == True
+assert aa_collision( ((0,0),(2,2)), [[3,0],[3,5]] ) == False
+
+
 def inside( point, path ):
     for previous, current in zip( path, path[1:]):
         if orientation( previous, current, point ) != 2:
@@ -153,68 +1161,558 @@ assert overlaps( [[10,10],[20,10],[20,20],[20,10],[10,10]],[[0,0],[30,0],[30,30]
 assert overlaps( [[10,10],[20,10],[20,20],[20,10],[10,10]],[[0,0],[15,0],[15,15],[0,15],[0,0]] ) == True
 assert overlaps( [[10,10],[20,10],[20,20],[20,10],[10,10]],[[30,0],[50,0],[50,30],[30,30],[30,0]] ) == False
 
-def check_crash( player, opponent ):
-    # Crash with someone else.
-    if opponent != player and collision( (player.pos, player.path[-1]), opponent.path ):
-        return True
-    # Crash with yourself.
-    elif collision( (player.pos, player.path[-1]), opponent.path[:-2] ):
-        return True
+class Path():
+    """The corners of a trail, flat in an array of doubles: x0, y0, x1, y1...
+
+    Corners read back as (x, y) tuples and slices as lists of them, so the
+    geometry functions take a Path like any other list of points. Growing
+    one appends two doubles rather than a tuple object per corner.
+    """
+
+    __slots__ = ( "coords", )
+
+    def __init__( self, points = () ):
+        self.coords = array.array( 'd' )
+        for x, y in points:
+            self.coords.append( x )
+            self.coords.append( y )
+
+    def __len__( self ):
+        return len( self.coords ) >> 1
+
+    def __iter__( self ):
+        coords = iter( self.coords )
+        return zip( coords, coords )
+
+    def __getitem__( self, i ):
+        coords = self.coords
+        if type( i ) is slice:
+            start, stop, step = i.indices( len( coords ) >> 1 )
+            if step != 1:
+                return [ self[j] for j in range( start, stop, step ) ]
+            coords = iter( coords[ start * 2 : stop * 2 ] )
+            return list( zip( coords, coords ) )
+        if i < 0:
+            i += len( coords ) >> 1
+            if i < 0:
+                raise IndexError( "path index out of range" )
+        i *= 2
+        return ( coords[i], coords[i + 1] )
+
+    def __setitem__( self, i, p ):
+        if i < 0:
+            i += len( self )
+        if not 0 <= i < len( self ):
+            raise IndexError( "path index out of range" )
+        self.coords[ i * 2 ] = p[0]
+        self.coords[ i * 2 + 1 ] = p[1]
+
+    def append( self, p ):
+        self.coords.append( p[0] )
+        self.coords.append( p[1] )
+
+    def keep( self, count ):
+        """Drop all but the last count corners."""
+        del self.coords[ : -count * 2 ]
+
+assert Path( [ (1, 2), (3, 4), (5, 6) ] )[-2:] == [ (3.0, 4.0), (5.0, 6.0) ]
+assert list( Path( [ (1, 2), (3, 4) ] ) ) == [ (1.0, 2.0), (3.0, 4.0) ]
+
+
+class SegmentIndex():
+    """Uniform grid of trail segments.
+
+    Each segment is filed under every GRID_CELL sized cell its bounding box
+    covers, so a crash test only looks at segments near the movement
+    instead of walking whole paths. A level files the boundary and every
+    trail in one index, segments still being drawn growing in place
+    through stretch().
+    """
+
+    def __init__( self, path = () ):
+        self.cells = {}
+        self.segments = []
+        self.bounds = []
+        self.spans = []
+        for previous, current in zip( path, path[1:] ):
+            self.add( previous, current )
+
+    def span( self, a, b ):
+        """The cells the segment ab covers, as column and row ranges x0, x1, y0, y1."""
+        return ( int( min( a[0], b[0] ) // GRID_CELL ), int( max( a[0], b[0] ) // GRID_CELL ),
+                 int( min( a[1], b[1] ) // GRID_CELL ), int( max( a[1], b[1] ) // GRID_CELL ) )
+
+    def cells_for( self, a, b ):
+        x0, x1, y0, y1 = self.span( a, b )
+        return [ (x, y) for x in range( x0, x1 + 1 ) for y in range( y0, y1 + 1 ) ]
+
+    def file( self, i, span, old = None ):
+        """Put segment i in the cells of span that aren't in old already."""
+        for x in range( span[0], span[1] + 1 ):
+            for y in range( span[2], span[3] + 1 ):
+                if old and old[0] <= x <= old[1] and old[2] <= y <= old[3]:
+                    continue
+                if (x, y) in self.cells:
+                    self.cells[(x, y)].append( i )
+                else:
+                    self.cells[(x, y)] = [ i ]
+
+    def add( self, a, b ):
+        """File the segment ab, returning its number."""
+        i = len( self.segments )
+        self.segments.append( ( tuple(a), tuple(b) ) )
+        self.bounds.append( bounds( a, b ) if axis_aligned( a, b ) else None )
+        self.spans.append( self.span( a, b ) )
+        self.file( i, self.spans[i] )
+        return i
+
+    def stretch( self, i, a, b ):
+        """Segment i now runs from a to b, covering at least what it did."""
+        self.segments[i] = ( tuple(a), tuple(b) )
+        self.bounds[i] = bounds( a, b ) if axis_aligned( a, b ) else None
+        span = self.span( a, b )
+        if span != self.spans[i]:
+            self.file( i, span, self.spans[i] )
+            self.spans[i] = span
+
+    def collision( self, seg, skip = () ):
+        """Does seg hit any segment but the ones numbered in skip?"""
+        cells = self.cells_for( seg[0], seg[1] )
+        if len( cells ) == 1:
+            candidates = self.cells.get( cells[0], () )
+        else:
+            candidates = set()
+            for cell in cells:
+                candidates.update( self.cells.get( cell, () ) )
+        if not axis_aligned( *seg ):
+            for i in candidates:
+                if i not in skip and intersect( ( seg, self.segments[i] ) ):
+                    return True
+            return False
+        box = bounds( *seg )
+        for i in candidates:
+            if i in skip:
+                continue
+            other = self.bounds[i]
+            if other is None:
+                if intersect( ( seg, self.segments[i] ) ):
+                    return True
+            elif overlap( box, other ):
+                return True
+        return False
 
-def check( player, opponent ):
-    for previous, current in zip( player.path, player.path[1:]):
-        if collision( (previous, current), opponent.path ):
-            return True
 
+def check_crash( player ):
+    coords = player.path.coords
+    seg = ( player.pos, ( coords[-2], coords[-1] ) )
+    # The segment being drawn and the one just turned off always touch the
+    # movement. Everything else, your own trail, everyone else's and the
+    # boundary, is in the level's index.
+    return player.index.collision( seg, ( player.live, player.turned ) )
+
+class FreeSpace():
+    """Where a powerup could still go.
+
+    The level is cut into FREE_CELL squares. The centre of a square is free
+    while a hit box POWER_UP_MARGIN around it is inside the boundary, clear
+    of every trail and clear of every other powerup's hit box. The free
+    centres are kept in a list as trails grow and powerups come and go.
+    """
+
+    def __init__( self, boundary, width, height ):
+        self.columns = int( width // FREE_CELL ) + 1
+        self.rows = int( height // FREE_CELL ) + 1
+        cells = self.columns * self.rows
+        self.trail = bytearray( cells )
+        self.covered = [0] * cells
+        self.free = []
+        self.slots = {}
+
+        # The boundary is a rectangle, so its bounding box will do.
+        x0 = min( p[0] for p in boundary.path ) + POWER_UP_MARGIN
+        x1 = max( p[0] for p in boundary.path ) - POWER_UP_MARGIN
+        y0 = min( p[1] for p in boundary.path ) + POWER_UP_MARGIN
+        y1 = max( p[1] for p in boundary.path ) - POWER_UP_MARGIN
+        self.inside = bytearray( cells )
+        for i in range( cells ):
+            x, y = self.centre( i )
+            if x0 < x < x1 and y0 < y < y1:
+                self.inside[i] = 1
+                self.add( i )
+
+    def centre( self, i ):
+        return ( i % self.columns * FREE_CELL + FREE_CELL // 2, i // self.columns * FREE_CELL + FREE_CELL // 2 )
+
+    def near( self, x0, x1, y0, y1, margin ):
+        """Cells whose centre is within margin of the box x0, x1, y0, y1."""
+        c0 = max( math.ceil( ( x0 - margin - FREE_CELL // 2 ) / FREE_CELL ), 0 )
+        c1 = min( math.floor( ( x1 + margin - FREE_CELL // 2 ) / FREE_CELL ), self.columns - 1 )
+        r0 = max( math.ceil( ( y0 - margin - FREE_CELL // 2 ) / FREE_CELL ), 0 )
+        r1 = min( math.floor( ( y1 + margin - FREE_CELL // 2 ) / FREE_CELL ), self.rows - 1 )
+        for row in range( r0, r1 + 1 ):
+            for i in range( row * self.columns + c0, row * self.columns + c1 + 1 ):
+                yield i
+
+    def add( self, i ):
+        if i not in self.slots:
+            self.slots[i] = len( self.free )
+            self.free.append( i )
+
+    def remove( self, i ):
+        slot = self.slots.pop( i, None )
+        if slot is not None:
+            last = self.free.pop()
+            if last != i:
+                self.free[slot] = last
+                self.slots[last] = slot
+
+    def block( self, a, b ):
+        """A trail now runs from a to b."""
+        for i in self.near( *bounds( a, b ), POWER_UP_MARGIN ):
+            if not self.trail[i]:
+                self.trail[i] = 1
+                self.remove( i )
+
+    def cover( self, x, y ):
+        """A powerup was put at x, y."""
+        for i in self.near( x, x, y, y, POWER_UP_MARGIN * 2 ):
+            self.covered[i] += 1
+            self.remove( i )
+
+    def uncover( self, x, y ):
+        """The powerup at x, y has gone."""
+        for i in self.near( x, x, y, y, POWER_UP_MARGIN * 2 ):
+            self.covered[i] -= 1
+            if not self.covered[i] and self.inside[i] and not self.trail[i]:
+                self.add( i )
+
+    def redraw( self, paths ):
+        """Start the trails over from paths, after they were cut short."""
+        self.trail = bytearray( len( self.trail ) )
+        for i in range( len( self.trail ) ):
+            if self.inside[i] and not self.covered[i]:
+                self.add( i )
+        for path in paths:
+            for previous, current in zip( path, path[1:] ):
+                self.block( previous, current )
+
+    def sample( self, rng ):
+        """A random free spot, or None when the level is full."""
+        if not self.free:
+            return None
+        return self.centre( self.free[ rng.randrange( len( self.free ) ) ] )
+
+
+class Occupancy():
+    """The level as a bitmap of BOT_CELL squares, set wherever the boundary
+    or a trail runs through.
+
+    sync brings it up to date with only the newest stretch of each trail,
+    the way draw_trails does, and starts over when the level was
+    reindexed because the trails were cut short."""
+
+    def __init__( self, width, height ):
+        self.columns = int( width // BOT_CELL ) + 1
+        self.rows = int( height // BOT_CELL ) + 1
+        self.cells = bytearray( self.columns * self.rows )
+        self.index = None
+        self.seen = {}
+
+    def cell( self, x, y ):
+        return int( y // BOT_CELL ) * self.columns + int( x // BOT_CELL )
+
+    def block( self, a, b ):
+        """A wall or trail now runs from a to b."""
+        x0, x1, y0, y1 = bounds( a, b )
+        c0 = max( int( x0 // BOT_CELL ), 0 )
+        c1 = min( int( x1 // BOT_CELL ), self.columns - 1 )
+        r0 = max( int( y0 // BOT_CELL ), 0 )
+        r1 = min( int( y1 // BOT_CELL ), self.rows - 1 )
+        for row in range( r0, r1 + 1 ):
+            start = row * self.columns
+            self.cells[ start + c0 : start + c1 + 1 ] = b"\1" * ( c1 - c0 + 1 )
+
+    def sync( self, level ):
+        if level.index is not self.index:
+            self.index = level.index
+            self.cells = bytearray( len( self.cells ) )
+            self.seen = {}
+            path = level.boundary.path
+            for previous, current in zip( path, path[1:] ):
+                self.block( previous, current )
+
+        for player in level.players:
+            path = player.path
+            if player in self.seen:
+                count, last = self.seen[player]
+                points = [ last ] + path[count - 1:]
+            else:
+                points = path[:]
+            for previous, current in zip( points, points[1:] ):
+                self.block( previous, current )
+            self.seen[player] = ( len( path ), path[-1] )
+
+
+class Bot():
+    """Plays a seat by pressing its keys, like anyone at the controls."""
+
+    def __init__( self, player, difficulty = "normal" ):
+        self.player = player
+        self.interval, self.horizon, self.depth, self.budget = BOT_LEVELS[ difficulty ]
+        self.wait = 0
+
+    def events( self, level, occupancy, deadline ):
+        """Key presses to make before the next tick, looking no later than deadline."""
+        player = self.player
+        self.wait -= 1
+        if player.time_of_death or self.wait > 0:
+            return
+        self.wait = self.interval
+
+        dx = ( player.vel[0] > 0 ) - ( player.vel[0] < 0 )
+        dy = ( player.vel[1] > 0 ) - ( player.vel[1] < 0 )
+        here = occupancy.cell( *player.pos )
+        if self.run( occupancy, here, dx, dy ) == self.horizon:
+            return
 
-def jitter():
-    return ( random.random() - 0.5 ) * 2;
+        # Straight on, left and right are scored by the room a flood fill
+        # finds past each, then how far it could go straight. The fills
+        # stop on the clock too, so unseeded headless matches with bots can
+        # differ from run to run; recordings keep the presses, so replays
+        # don't. Straight on goes first, so it wins a tie.
+        deadline = min( deadline, time.perf_counter() + self.budget / 1000 )
+        best = None
+        for ox, oy in ( ( dx, dy ), ( dy, -dx ), ( -dy, dx ) ):
+            run = self.run( occupancy, here, ox, oy )
+            if run:
+                score = ( self.room( occupancy, here + ox + oy * occupancy.columns, deadline ), run )
+                if best is None or score > best[0]:
+                    best = ( score, ox, oy )
+
+        if best and ( best[1], best[2] ) != ( dx, dy ):
+            key = { ( 0, -1 ): Keys.UP, ( 0, 1 ): Keys.DOWN, ( -1, 0 ): Keys.LEFT, ( 1, 0 ): Keys.RIGHT }[ best[1:] ]
+            yield pygame.event.Event( pygame.KEYDOWN, key = player.keys[key] )
+
+    def run( self, occupancy, here, dx, dy ):
+        """Free cells in a straight line from here, up to the horizon."""
+        cells = occupancy.cells
+        step = dx + dy * occupancy.columns
+        i = here
+        for run in range( self.horizon ):
+            i += step
+            if not 0 <= i < len( cells ) or cells[i]:
+                return run
+        return self.horizon
+
+    def room( self, occupancy, start, deadline ):
+        """Free cells reachable from start, counting up to depth of them."""
+        if time.perf_counter() > deadline:
+            return 0
+        # Blocked and already counted cells both read as set in seen. The
+        # boundary closes off the level, so the fill never runs off the edge.
+        seen = bytearray( occupancy.cells )
+        columns = occupancy.columns
+        seen[start] = 1
+        stack = [ start ]
+        count = 1
+        pops = 0
+        while stack and count < self.depth:
+            pops += 1
+            if not pops % 16 and time.perf_counter() > deadline:
+                break
+            i = stack.pop()
+            for j in ( i - 1, i + 1, i - columns, i + columns ):
+                if not seen[j]:
+                    seen[j] = 1
+                    count += 1
+                    stack.append( j )
+        return count
+
+
+def jitter( rng = random ):
+    return ( rng.random() - 0.5 ) * 2;
 
 def limit( a ):
     return max( min( round( a ), 255 ), 0 )
 
 class Particle:
-    def __init__(self, start, vel, col ):
-        self.pos = start
-        self.vel = vel
+    __slots__ = ( "x", "y", "vx", "vy", "col", "heat" )
+
+    def __init__(self, x, y, vx, vy, col ):
+        self.x = x
+        self.y = y
+        self.vx = vx
+        self.vy = vy
         self.col = col
         self.heat = 1
 
+# Below this a particle would be drawn fully transparent.
+COLD = 0.5 / 255
+
+class ParticleList():
+
+    """Particles as a list of objects, for when numpy isn't installed."""
+
+    def __init__( self ):
+        self.particles = []
+
+    def __len__( self ):
+        return len( self.particles )
+
+    def emit( self, pos, vel, col, count, spread, rng ):
+        for i in range(0,count):
+            self.particles.append( Particle( pos[0], pos[1], vel[0] + jitter( rng ) * spread,
+                                             vel[1] + jitter( rng ) * spread, pygame.Color( col ) ) )
+
+    def update( self, delta_time ):
+        cooling = math.pow( math.e, - delta_time / 1000.0 )
+        for particle in self.particles:
+            particle.x += particle.vx * delta_time / 1000.0
+            particle.y += particle.vy * delta_time / 1000.0
+            particle.vx *= 0.99
+            particle.vy *= 0.99
+            particle.heat *= cooling
+        self.particles = [ particle for particle in self.particles if particle.heat >= COLD ]
+
+    def draw( self, surface ):
+        for particle in self.particles:
+            r = limit( 300 * particle.heat + jitter() * SPARKLE )
+            g = limit( 300 * particle.heat + jitter() * SPARKLE )
+            b = limit( 100 * particle.heat + jitter() * SPARKLE )
+            col = particle.col + pygame.Color( r, g, b )  
+            surface.set_at( (round(particle.x),round(particle.y) ), faded( col, round( 255 * particle.heat ) ) )
+
+
+class ParticleSystem():
+
+    """Particles kept as numpy arrays, one row per particle.
+
+    Integration, cooling and culling happen for every particle at once, and
+    drawing writes all the pixels in one go through Canvas.set_pixels."""
+
+    HEAT_COLOUR = ( 300, 300, 100 )
+
+    def __init__( self ):
+        self.pos = numpy.zeros( (0, 2) )
+        self.vel = numpy.zeros( (0, 2) )
+        self.heat = numpy.zeros( 0 )
+        self.col = numpy.zeros( (0, 3) )
+
+    def __len__( self ):
+        return len( self.heat )
+
+    def emit( self, pos, vel, col, count, spread, rng ):
+        # Seeded from the level's random so a seeded match explodes the same way.
+        spray = numpy.random.default_rng( rng.getrandbits(64) ).uniform( -1, 1, (count, 2) )
+        col = pygame.Color( col )
+        self.pos = numpy.concatenate( ( self.pos, numpy.tile( pos, (count, 1) ) ) )
+        self.vel = numpy.concatenate( ( self.vel, numpy.asarray( vel, dtype=float ) + spray * spread ) )
+        self.heat = numpy.concatenate( ( self.heat, numpy.ones( count ) ) )
+        self.col = numpy.concatenate( ( self.col, numpy.tile( (col.r, col.g, col.b), (count, 1) ) ) )
+
+    def update( self, delta_time ):
+        self.pos += self.vel * ( delta_time / 1000.0 )
+        self.vel *= 0.99
+        self.heat *= math.exp( - delta_time / 1000.0 )
+
+        alive = self.heat >= COLD
+        if not alive.all():
+            self.pos = self.pos[alive]
+            self.vel = self.vel[alive]
+            self.heat = self.heat[alive]
+            self.col = self.col[alive]
+
+    def draw( self, surface ):
+        if not len( self ):
+            return
+        xy = numpy.rint( self.pos ).astype( int )
+        heat = self.heat
+
+        sparkle = numpy.random.uniform( -SPARKLE, SPARKLE, (len(heat), 3) )
+        glow = numpy.clip( numpy.rint( numpy.outer( heat, self.HEAT_COLOUR ) + sparkle ), 0, 255 )
+        col = numpy.minimum( self.col + glow, 255 )
+        # Cooling particles fade out towards black.
+        col = col * numpy.rint( 255 * heat )[:,None] // 255
+
+        surface.set_pixels( xy[:,0], xy[:,1], col )
+
 class Boundary:
+    __slots__ = ( "path", )
+
     def __init__( self, path ):
-        self.path = path
+        self.path = Path( path )
 
 class Player:
+    # pos and vel are lists changed in place and path only ever grows at
+    # the end, so a tick allocates next to nothing. They're lists rather
+    # than arrays because they are read far more often than written.
+    __slots__ = ( "keys", "pos", "vel", "col", "name", "path", "joystick", "time_of_death",
+                  "score", "bonus", "powerup", "boost", "index", "live", "turned", "bot" )
+
     def __init__(self, keys, start, vel, col, name ):
         self.keys = keys
-        self.pos = start
-        self.vel = vel
+        self.pos = list( start )
+        self.vel = list( vel )
         self.col = pygame.Color(col)
         self.name = name
-        self.path = [ start, start ]
+        self.path = Path( [ start, start ] )
         self.joystick = None
         self.time_of_death = 0
         self.score = 0
         self.bonus = 0
         self.powerup = None
         self.boost = 1
+        # The level's SegmentIndex, and the numbers in it of the segment
+        # being drawn and the one before, see Level.reindex.
+        self.index = None
+        self.live = None
+        self.turned = None
+        self.bot = None
+
+    def turn( self, vel ):
+        """Change direction, finishing the segment drawn so far."""
+        self.vel[0], self.vel[1] = vel
+        self.path.append( self.pos )
+        self.turned = self.live
+        self.live = self.index.add( self.pos, self.pos )
+
+    def extend( self ):
+        """The segment being drawn now reaches pos."""
+        self.path[-1] = self.pos
+        self.index.stretch( self.live, self.path[-2], self.pos )
+
+    def truncate( self ):
+        """Drop everything but the segment currently being drawn."""
+        self.path.keep( 2 )
 
 
 class Powerup:
+    __slots__ = ( "x", "y", "active_time" )
+    ICON = None
+
     def __init__( self, x, y ):
         self.x = x
         self.y = y
-        self.icon = None
         self.active_time = None
 
     def draw(self, surface, width, height):
-        surface.blit( self.icon, ( self.x - POWER_UP_SIZE // 2, self.y - POWER_UP_SIZE // 2 ) )
+        surface.blit( assets.get( self.ICON, surface.angle ), ( self.x - POWER_UP_SIZE // 2, self.y - POWER_UP_SIZE // 2 ) )
 
     def hit_test( self, pos):
         return ( pos[0] > self.x - POWER_UP_SIZE // 2 and
                pos[0] < self.x + POWER_UP_SIZE // 2 and
                pos[1] > self.y - POWER_UP_SIZE // 2 and
                pos[1] < self.y + POWER_UP_SIZE // 2 )
+
+    def sweep_test( self, a, b ):
+        """Does moving from a to b pass through the icon?"""
+        if not axis_aligned( a, b ):
+            return self.hit_test( b )
+        x0, x1, y0, y1 = bounds( a, b )
+        return ( x1 > self.x - POWER_UP_SIZE // 2 and
+               x0 < self.x + POWER_UP_SIZE // 2 and
+               y1 > self.y - POWER_UP_SIZE // 2 and
+               y0 < self.y + POWER_UP_SIZE // 2 )
         
 
     def update( self, delta_time ):
@@ -224,9 +1722,11 @@ class Powerup:
         pass
 
 class Boost(Powerup):
+    __slots__ = ( "player", "boost" )
+    ICON = "boost"
+
     def __init__( self, x, y ):
         Powerup.__init__( self, x, y )
-        self.icon = pygame.image.load("boost.bmp")
         self.player = None
         self.boost = 2
 
@@ -248,53 +1748,74 @@ class Boost(Powerup):
             self.player.boost = 1
 
 class Coin(Powerup):
+    __slots__ = ()
+    ICON = "coin"
+
     def __init__( self, x, y ):
         Powerup.__init__( self, x, y )
-        self.icon = pygame.image.load("coin.bmp")
 
     def trigger( self, player, level ):
         player.score += COIN_SCORE
 
 class Brakes(Boost):
+    __slots__ = ()
+    ICON = "brakes"
+
     def __init__( self, x, y ):
         Boost.__init__( self, x, y )
-        self.icon = pygame.image.load("brakes.bmp")
         self.boost = 0.5
 
 class Clear(Powerup):
+    __slots__ = ()
+    ICON = "clear"
+
     def __init__( self, x, y ):
         Powerup.__init__( self, x, y )
-        self.icon = pygame.image.load("clear.bmp")
 
     def trigger( self, player, level ):
         for player in level.players:
-            player.path = player.path[-2:]
+            player.truncate()
+        level.reindex()
+        level.trails_dirty = True
+        level.free_space.redraw( [ player.path for player in level.players ] )
 
 class HiscoreScreen():
 
     def __init__( self ):
-        player_scores = collections.defaultdict(int)
-        for player_name, data in highscores.items():
-            for opponent_name, score in data.items():
-                player_scores[player_name] += score
-        self.scores = sorted( player_scores.items(), key = lambda kv: kv[1], reverse=True )
+        self.scores = highscores.leaderboard()
+        self.version = highscores.version
         self.start = 0
+        self.players = 2
         self.message = ""
 
 
     def draw(self, width, height, surface):
-        surface.blit( logo, ( 50, height // 2 - logo.get_height() // 2 ) )
+        logo = assets["logo"]
+        surface.blit( assets.get( "logo", surface.angle ), ( 50, height // 2 - logo.get_height() // 2 ) )
         write( surface, 200, height // 2, "Hi Scores", True )
         for i, score in enumerate( self.scores ):
             x = 300 + ( FONT_SIZE + MARGIN ) * i
+            # The rest are off the screen, and writing them anyway would
+            # push what's on it out of the text cache.
+            if x >= width:
+                break
             write( surface, x, height * 2 // 3 + FONT_SIZE * 2 // 3, score[0] )
-            write( surface, x, height // 3, str( score[1] ) )
+            write( surface, x, height // 3, str( int( score[1] ) ) )
         write( surface, width - 100, height // 2, self.message, True )
 
 
     def update( self, delta_time, width, height ):
+        # Picks up the last match once the writer has saved it.
+        if highscores.version != self.version:
+            self.scores = highscores.leaderboard()
+            self.version = highscores.version
+
         if self.start == 1:
-            return Level( width, height )
+            return Level( width, height, joysticks, players = self.players, bots = bots[ : self.players ] )
+
+    def idle( self ):
+        """True while nothing on screen changes until there's input."""
+        return self.start != 1 and highscores.version == self.version
 
 
     def handle(self, event ):
@@ -302,7 +1823,9 @@ class HiscoreScreen():
             self.message = "Key " + str( event.key )
             if event.key == pygame.K_1:
                 self.start = 0
-            if event.key == pygame.K_2:
+            # 2 to 8 start a match for that many.
+            if pygame.K_2 <= event.key <= pygame.K_0 + len( PLAYERS ):
+                self.players = event.key - pygame.K_0
                 self.start = 1
         if event.type == pygame.JOYBUTTONDOWN:
             self.message = "Down " + str( event.button ) + " id " + str(event.instance_id)
@@ -310,50 +1833,84 @@ class HiscoreScreen():
             self.message = "Up " + str( event.button ) + " id " + str(event.instance_id)
             if event.button == 9:
                 self.start = event.instance_id
+                self.players = min( max( len( joysticks ), 2 ), len( PLAYERS ) )
 
 
 
 class ScoreScreen():
 
+    # Name wheels sit side by side this far apart once there are more
+    # players than SCORE_ROWS.
+    WHEEL_SPACING = FONT_SIZE * 8
+
     def __init__( self, players ):
         self.players = players
         self.alphabet = "-ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-        self.wheel_offsets = [0,0]
-        self.wheel_vels = [0,0]
-
-        self.letters = [[0,0,0],[0,0,0]]
-        self.columns = [0,0]
-        self.shift = [0,0]
+        count = len( players )
+        self.wheel_offsets = [0] * count
+        self.wheel_vels = [0] * count
+
+        self.letters = [ [0,0,0] for player in players ]
+        self.columns = [0] * count
+        self.controls = bindings.compile( players )
+        # Whoever is left wins, or if nobody is, whoever crashed last.
+        alive = [ player for player in players if not player.time_of_death ]
+        last = max( player.time_of_death for player in players )
+        self.winners = alive or [ player for player in players if player.time_of_death == last ]
+
+        # Nobody can enter a name for a seat with neither keys nor a joystick,
+        # and bots sign theirs straight away.
+        for p, player in enumerate( players ):
+            if player.bot:
+                self.letters[p] = [ self.alphabet.index( letter ) for letter in BOT_NAME ]
+                self.columns[p] = 3
+            elif player.keys is NO_KEYS and not player.joystick:
+                self.columns[p] = 3
 
         self.finished = False
 
         self.message = ""
 
+    def slot( self, p, height ):
+        """x of player p's name wheel and y of the middle of their part of the screen."""
+        rows = min( len( self.players ), SCORE_ROWS )
+        return 500 + p // rows * self.WHEEL_SPACING, height - ( 2 * ( p % rows ) + 1 ) * height // ( 2 * rows )
 
     def draw(self, width, height, surface):
 
-        write( surface, MARGIN, height - MARGIN, str(int(self.players[0].score) ) )
-        write( surface, MARGIN, height // 2 - MARGIN, str(int(self.players[1].score) ) )
+        count = len( self.players )
+        columns = score_columns( count )
+        rows = min( count, SCORE_ROWS )
+
+        for p, player in enumerate( self.players ):
+            x, y = score_position( p, count, height )
+            write( surface, x, y, str(int(player.score) ) )
 
-        if self.players[1].time_of_death:
-            write( surface, 100, height * 3 // 4, self.players[0].name, True)
-            write( surface, 100 + FONT_SIZE + MARGIN, height * 3 // 4, "WINS!", True)
-                
-        if self.players[0].time_of_death:
-            write( surface, 100, height // 4, self.players[1].name, True )
-            write( surface, 100 + FONT_SIZE + MARGIN, height // 4, "WINS!", True )
+        for p, player in enumerate( self.players ):
+            if player in self.winners:
+                x, y = self.slot( p, height )
+                write( surface, 50 + FONT_SIZE * columns, y, player.name, True)
+                write( surface, 50 + FONT_SIZE * ( columns + 1 ) + MARGIN, y, "WINS!", True)
 
         f = FONT_SIZE * 3 // 2
+        m = 15
+
+        for p, player in enumerate( self.players ):
+            x0, y0 = self.slot( p, height )
+            surface.lines( player.col, True, [
+                              [ x0 + FONT_SIZE, y0 - f ], 
+                              [ x0 + FONT_SIZE, y0 + f + m ], 
+                              [ x0 - m, y0 + f + m ], 
+                              [ x0 - m, y0 - f] ] , LINE_WIDTH)
 
-        for p in range(0,2):
             for c in range(0,3):
                 if c != self.columns[p]:
                     l = self.letters[p][c] 
                     y = c * FONT_SIZE - f
-                    write( surface, 500, height * 3 // 4 - p * height // 2 - y, self.alphabet[ l ] )
+                    write( surface, x0, y0 - y, self.alphabet[ l ] )
             if self.columns[p] == 3:
-                pygame.draw.rect( surface, [255,255,255], 
-                          [ 500 + 10, height * 3 // 4 - p * height // 2 - f - 10, 
+                surface.rect( [255,255,255], 
+                          [ x0 + 10, y0 - f - 10, 
                            20,20 ])
 
 
@@ -362,27 +1919,20 @@ class ScoreScreen():
                 l = ( self.letters[p][self.columns[p]] + letter ) % len( self.alphabet )
                 x = letter * FONT_SIZE + self.wheel_offsets[p]
                 y = self.columns[p] * FONT_SIZE - f
-                write( surface, 500 + x, height * 3 // 4 - p * height // 2 - y, self.alphabet[ l ] )
-
-        m = 15
-        pygame.draw.lines( surface, [0,0,255], True, [
-                          [ 500 + FONT_SIZE, height // 4 - f], 
-                          [ 500 + FONT_SIZE, height // 4 + f + m ], 
-                          [ 500 - m, height // 4 + f + m ], 
-                          [ 500 - m, height // 4 - f] ] , LINE_WIDTH)
-
-        pygame.draw.lines( surface, [255,0,0], True, [
-                          [ 500 + FONT_SIZE, height * 3 // 4 - f ], 
-                          [ 500 + FONT_SIZE, height * 3 // 4 + f + m ], 
-                          [ 500 - m, height * 3 // 4 + f + m ], 
-                          [ 500 - m, height * 3 // 4 - f] ] , LINE_WIDTH)
+                write( surface, x0 + x, y0 - y, self.alphabet[ l ] )
 
-        pygame.draw.line( surface, [255,255,0], [ MARGIN * 2 + FONT_SIZE, height // 2 ], [ width - MARGIN, height // 2 ], LINE_WIDTH)
+        for r in range( 1, rows ):
+            y = height - r * height // rows
+            surface.line( [255,255,0], [ MARGIN * 2 + FONT_SIZE * columns, y ], [ width - MARGIN, y ], LINE_WIDTH)
+        for c in range( 1, columns ):
+            x = 500 + ( 2 * c - 1 ) * self.WHEEL_SPACING // 2
+            surface.line( [255,255,0], [ x, MARGIN ], [ x, height - MARGIN ], LINE_WIDTH)
 
         write( surface, width - 100, height // 2, self.message, True )
 
     def update( self, delta_time, width, height):
-        delta = delta_time
+        # Whole points a tick, so the scores saved stay whole.
+        delta = max( 1, round( delta_time ) )
         for player in self.players:
             delta_score = 0
             if player.bonus > delta:
@@ -394,13 +1944,13 @@ class ScoreScreen():
             player.score += delta_score
 
 
-        for p in range(0,2):
+        for p in range( len( self.players ) ):
             l = int( self.wheel_offsets[p] / FONT_SIZE )
             if l:
                 self.letters[p][self.columns[p]] = ( self.letters[p][self.columns[p]] - l ) % len( self.alphabet )
                 self.wheel_offsets[p] -= FONT_SIZE * l
 
-        for p in range(0,2):
+        for p in range( len( self.players ) ):
             self.wheel_offsets[p] += self.wheel_vels[p] * delta_time / 1000.0
             self.wheel_offsets[p] *= math.pow( math.e, - delta_time / 1000.0 * 1 )
             self.wheel_vels[p] *= math.pow( math.e, - delta_time / 1000.0 * 10 )
@@ -413,65 +1963,50 @@ class ScoreScreen():
     def handle(self, event):
         if event.type == pygame.KEYDOWN:
             if event.key == pygame.K_SPACE:
-                if self.columns[0] == 3 and self.columns[1] == 3:
+                if all( column == 3 for column in self.columns ):
                     self.finished = True
-            for p in range(0,2):
-                if self.columns[p] == 3:
-                    continue
-                player = self.players[p]
-                if event.key == player.keys[ Keys.RIGHT ]:
-                    self.wheel_vels[p] = -800
-                if event.key == player.keys[ Keys.LEFT ]:
-                    self.wheel_vels[p] = +800
-        if event.type == pygame.KEYUP:
-            for p in range(0,2):
-                player = self.players[p]
-                if event.key == player.keys[ Keys.UP ]:
-                    self.columns[p] = min( self.columns[p] + 1, 3 )
-                if event.key == player.keys[ Keys.DOWN ]:
-                    self.columns[p] = max( self.columns[p] - 1, 0 )
         if event.type == pygame.JOYBUTTONDOWN:
             self.message = "Button: " + str(event.button)
             if event.button == 1:
-                if self.columns[0] == 3 and self.columns[1] == 3:
+                if all( column == 3 for column in self.columns ):
                     self.finished = True
-        if event.type == pygame.JOYAXISMOTION:
-            p = event.instance_id
-            player = self.players[p]
-            if player.joystick.get_axis(0) < -DEADZONE and abs( player.joystick.get_axis(1) ) < DEADZONE:
-                self.shift[p] = -1
-            if player.joystick.get_axis(0) > DEADZONE and abs( player.joystick.get_axis(1) ) < DEADZONE:
-                self.shift[p] = +1
-            if self.columns[p] != 3:
-                if player.joystick.get_axis(1) < -DEADZONE and abs( player.joystick.get_axis(0) ) < DEADZONE:
-                    self.wheel_vels[p] = +800
-                if player.joystick.get_axis(1) > DEADZONE and abs( player.joystick.get_axis(0) ) < DEADZONE:
-                    self.wheel_vels[p] = -800
-            if abs(player.joystick.get_axis(0) ) < DEADZONE and abs( player.joystick.get_axis(1) ) < DEADZONE and self.shift[p] != 0:
-                self.columns[p] = max( min( self.columns[p] + self.shift[p], 3 ), 0 )
-                self.shift[p] = 0
+
+        # Left and right spin the wheel while it's being filled in, up and
+        # down move between letters when they're let go of.
+        control = self.controls.read( event )
+        if control is None:
+            return
+        p, action, pressed = control
+        if pressed and self.columns[p] != 3:
+            if action == Keys.RIGHT:
+                self.wheel_vels[p] = -800
+            if action == Keys.LEFT:
+                self.wheel_vels[p] = +800
+        if not pressed:
+            if action == Keys.UP:
+                self.columns[p] = min( self.columns[p] + 1, 3 )
+            if action == Keys.DOWN:
+                self.columns[p] = max( self.columns[p] - 1, 0 )
 
     
     def save(self):
-        scores = {}
-        names=["",""]
-        for p in range(0,2):
+        signed = []
+        for p, player in enumerate( self.players ):
+            # Seats nobody played aren't anyone's score.
+            if player.keys is NO_KEYS and not player.joystick and not player.bot:
+                continue
             name = ""
             for l in self.letters[p]:
                 name += self.alphabet[l]
-            score = self.players[p].score
-            scores[name] = score
-            names[p] = name
+            signed.append( ( name, player ) )
+
+        # Bots all sign the same, so a name twice over gets its seat's
+        # colour to keep each score apart.
+        names = [ name for name, player in signed ]
+        scores = [ ( name if names.count( name ) == 1 else "%s %s" % ( name, player.name ), int( player.score ) )
+                   for name, player in signed ]
 
-        for p in range(0,2):
-            name = names[p]
-            other = names[(p+1)%2]
-            if name not in highscores:
-                highscores[name] = {}
-            highscores[name][other] = scores[name]
-       
-        with open('highscores.json','w') as f:
-            json.dump( highscores, f )
+        writer.submit( highscores.record_all, scores )
 
 
 
@@ -479,174 +2014,245 @@ class ScoreScreen():
 
 class Level():
 
-    def __init__(self, width, height):
+    def __init__(self, width, height, joysticks = (), seed = None, players = 2, bots = ()):
 
+        self.width = width
+        self.height = height
         self.speed = height * 0.1
         self.time = 0
+        self.ticks = 0
+
+        # Gameplay randomness comes from here so a seeded level plays out
+        # the same every time. Purely cosmetic randomness doesn't. An
+        # unseeded level picks a seed of its own, so it can still be
+        # recorded and replayed.
+        if seed is None:
+            seed = random.getrandbits( 63 )
+        self.seed = seed
+        self.random = random.Random( seed )
+
+        self.particles = ParticleSystem() if numpy else ParticleList()
+
+        # Players start in pairs heading for each other, a row per pair.
+        rows = ( players + 1 ) // 2
+        self.players = []
+        for p, ( name, col, _ ) in enumerate( PLAYERS[:players] ):
+            keys = bindings.keys[p]
+            y = height * ( p // 2 + 1 ) / ( rows + 1 )
+            if p % 2:
+                self.players.append( Player( keys, [width*0.8, y], [-self.speed,0], col, name ) )
+            else:
+                self.players.append( Player( keys, [width*0.2, y], [self.speed,0], col, name ) )
 
-        self.particles = []
-
-        self.players = [
-                    Player( [pygame.K_a,pygame.K_d,pygame.K_w,pygame.K_s,pygame.K_c], [width*0.2, height*0.5], [self.speed,0], (230,20,20), "RED" ),
-                    Player( [pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_SPACE ], [width*0.8,height*0.5], [-self.speed,0], (20,20,230), "BLUE" )
-            ]
-
+        # The scores go down the left, leaving room for more columns of them.
         border = 20
-        self.boundary = Boundary( [ [ 50 + border, border], 
+        left = FONT_SIZE * score_columns( players ) + border
+        self.boundary = Boundary( [ [ left, border], 
                                     [ width - border, border], 
                                     [ width - border, height - border ], 
-                                    [ 50 + border, height - border ], 
-                                    [ 50 + border, border] ] )
-
-        self.lookup = { joysticks[x].get_instance_id() : self.players[x]  for x in range(len(joysticks)) }
-
-        for x in range(pygame.joystick.get_count()):
-            self.players[x].joystick = joysticks[x]
+                                    [ left, height - border ], 
+                                    [ left, border] ] )
+        self.reindex()
+
+        self.lookup = { joystick.get_instance_id() : player for joystick, player in zip( joysticks, self.players ) }
+
+        for joystick, player in zip( joysticks, self.players ):
+            player.joystick = joystick
+        self.controls = bindings.compile( self.players )
+        # Which way each direction turns, for a player going the other way.
+        self.turns = { Keys.UP: [ 0, -self.speed ], Keys.DOWN: [ 0, +self.speed ],
+                       Keys.LEFT: [ -self.speed, 0 ], Keys.RIGHT: [ +self.speed, 0 ] }
+
+        # A bot of each difficulty in bots, taking the last seats with keys
+        # as it plays by pressing them.
+        seats = [ player for player in self.players if player.keys is not NO_KEYS ][::-1]
+        if len( bots ) > len( seats ):
+            raise ValueError( "only %d seats can have bots" % len( seats ) )
+        self.bots = []
+        for difficulty, player in zip( bots, seats ):
+            player.bot = Bot( player, difficulty )
+            self.bots.append( player.bot )
+        self.occupancy = Occupancy( width, height ) if self.bots else None
+        # When the bots have to be done by, for every tick of this frame.
+        # None gives each tick BOT_FRAME_BUDGET of its own.
+        self.deadline = None
 
         self.powerups = []
         self.powerup_timer = POWER_UP_SPAWN
+        self.free_space = FreeSpace( self.boundary, width, height )
+
+        # The boundary and the trails of living players are kept on an
+        # off-screen layer that only has the newest stretch of each trail
+        # drawn on it per frame. Anything that changes the trails in any
+        # other way sets trails_dirty to have it rebuilt.
+        self.trail_layer = None
+        self.trails_dirty = True
+        # Dead players whose trails have faded right out.
+        self.faded = set()
+        self.drawn = {}
+
+    def reindex( self ):
+        """File the boundary and every trail afresh, after the trails were
+        changed other than by moving and turning."""
+        self.index = SegmentIndex( self.boundary.path )
+        for player in self.players:
+            path = player.path
+            player.index = self.index
+            player.turned = None
+            for i in range( len( path ) - 2 ):
+                player.turned = self.index.add( path[i], path[i + 1] )
+            player.live = self.index.add( path[-2], path[-1] )
+
+    def draw_trails(self, width, height, surface):
+        if self.trail_layer is None:
+            self.trail_layer = surface.layer()
+        surface.set_background( self.trail_layer )
+
+        if self.trails_dirty:
+            self.trail_layer.fill(BLACK)
+            self.trail_layer.lines( [255,255,0], False, self.boundary.path, LINE_WIDTH)
+            for player in self.players:
+                if not player.time_of_death:
+                    self.trail_layer.lines( player.col, False, player.path, LINE_WIDTH)
+                    self.drawn[player] = ( len( player.path ), tuple( player.path[-1] ) )
+            self.trails_dirty = False
+            surface.invalidate()
+        else:
+            for player in self.players:
+                if not player.time_of_death:
+                    # Everything up to the point the trail had reached last
+                    # frame is already on the layer.
+                    count, last = self.drawn[player]
+                    points = [ last ] + player.path[count - 1:]
+                    if points[-1] != last:
+                        surface.restore( self.trail_layer.lines( player.col, False, points, LINE_WIDTH) )
+                    self.drawn[player] = ( len( player.path ), tuple( player.path[-1] ) )
 
     def draw(self, width, height, surface):
-        pygame.draw.lines( surface, [255,255,0], False, self.boundary.path, LINE_WIDTH)
+        with profiler.section( "trails" ):
+            self.draw_trails( width, height, surface )
 
         for player in self.players:
             if not player.time_of_death:
-                pygame.draw.lines( surface, player.col, False, player.path, LINE_WIDTH)
                 col = player.col
                 if player.powerup and ( player.powerup.active_time > 3000 or player.powerup.active_time // 300 % 2 ):
                     col = pygame.Color(255,255,255)
-                pygame.draw.rect( surface, col, pygame.Rect( player.pos[0]-2, player.pos[1]-2, 5, 5) )
-            else:
-                col = player.col
-                col.a = round( 255 * ( 1.0 - min(self.time - player.time_of_death, MS_DECAY) / MS_DECAY ) )
-                pygame.draw.lines( surface, col, False, player.path, LINE_WIDTH)
-
-        for particle in self.particles:
-            SPARKLE = 100
-            r = limit( 300 * particle.heat + jitter() * SPARKLE )
-            g = limit( 300 * particle.heat + jitter() * SPARKLE )
-            b = limit( 100 * particle.heat + jitter() * SPARKLE )
-            col = particle.col + pygame.Color( r, g, b )  
-            col.a = round( 255 * particle.heat )
-            surface.set_at( (round(particle.pos[0]),round(particle.pos[1]) ), col )
+                surface.rect( col, pygame.Rect( player.pos[0]-2, player.pos[1]-2, 5, 5) )
+            elif self.time - player.time_of_death < MS_DECAY:
+                alpha = round( 255 * ( 1.0 - ( self.time - player.time_of_death ) / MS_DECAY ) )
+                surface.lines( faded( player.col, alpha ), False, player.path, LINE_WIDTH)
+            elif player not in self.faded:
+                # Gone, so it stops being drawn, with the layer rebuilt
+                # once to leave nothing of it behind.
+                self.faded.add( player )
+                self.trails_dirty = True
+
+        with profiler.section( "particles" ):
+            self.particles.draw( surface )
 
         for powerup in self.powerups:
             if not powerup.active_time:
                 powerup.draw( surface, width, height )
 
-        write( surface, MARGIN, height - MARGIN, str(int(self.players[0].score) ) )
-        write( surface, MARGIN, height // 2 - MARGIN, str(int(self.players[1].score) ) )
+        for p, player in enumerate( self.players ):
+            x, y = score_position( p, len( self.players ), height )
+            write( surface, x, y, str(int(player.score) ) )
 
     def update( self, delta_time, width, height ):
+        # Bots press their keys before the tick, as if their presses had
+        # come in with everyone else's since the last one.
+        deadline = self.deadline
+        if deadline is None:
+            deadline = time.perf_counter() + BOT_FRAME_BUDGET / 1000
+        # Past it, the bots carry straight on this tick, and sync catches
+        # up with the trails next time.
+        if self.bots and time.perf_counter() < deadline:
+            with profiler.section( "bots" ):
+                self.occupancy.sync( self )
+                for bot in self.bots:
+                    for event in bot.events( self, self.occupancy, deadline ):
+                        recorder.event( self, event )
+                        self.handle( event )
+
         self.time += delta_time
-        time_of_death = 0
+        self.ticks += 1
+        deaths = []
+        moved_from = {}
 
         for player in self.players:
             if player.time_of_death:
-                if time_of_death:
-                    time_of_death = min( player.time_of_death, time_of_death)
-                else:
-                    time_of_death = player.time_of_death
+                deaths.append( player.time_of_death )
                 continue
 
             if player.powerup:
                 player.powerup.update( delta_time )
 
-            player.pos = ( 
-                player.pos[0] + player.vel[0] * player.boost * delta_time / 1000, 
-                player.pos[1] + player.vel[1] * player.boost * delta_time / 1000)
+            moved_from[player] = player.path[-1]
+            player.pos[0] += player.vel[0] * player.boost * delta_time / 1000
+            player.pos[1] += player.vel[1] * player.boost * delta_time / 1000
         
-            if check_crash( player, self.boundary ):
-                self.crash(player)
-
-            for opponent in self.players:
-                if check_crash( player, opponent ):
+            with profiler.section( "collision" ):
+                if check_crash( player ):
                     self.crash(player)
 
-            player.path[-1] = player.pos
+            player.extend()
+            with profiler.section( "spawn" ):
+                self.free_space.block( moved_from[player], player.pos )
 
-        for particle in self.particles:
-            particle.pos = ( 
-                particle.pos[0] + particle.vel[0] * delta_time / 1000.0, 
-                particle.pos[1] + particle.vel[1] * delta_time / 1000.0)
-            particle.vel = ( 
-                particle.vel[0] * 0.99, 
-                particle.vel[1] * 0.99)
-            particle.heat *= math.pow( math.e, - delta_time / 1000.0 )
+        with profiler.section( "particles" ):
+            self.particles.update( delta_time )
 
         self.powerup_timer -= delta_time
         if self.powerup_timer <= 0:
-            while True:
-                x = int( random.random() * width )
-                y = int( random.random() * height )
-                hit_box = Boundary(
-                            [[x - POWER_UP_MARGIN, y - POWER_UP_MARGIN],
-                             [x + POWER_UP_MARGIN, y - POWER_UP_MARGIN],
-                             [x + POWER_UP_MARGIN, y + POWER_UP_MARGIN],
-                             [x - POWER_UP_MARGIN, y + POWER_UP_MARGIN],
-                             [x - POWER_UP_MARGIN, y - POWER_UP_MARGIN]])
-               
-                suitable = True 
-                if not contains( hit_box.path, self.boundary.path ):
-                    print("Boundary")
-                    suitable = False
-                
-                if check( self.players[0], hit_box ):
-                    print("Player 1")
-                    suitable = False
-
-                if check( self.players[1], hit_box ):
-                    print("Player 2")
-                    suitable = False
-                
-                for powerup in self.powerups:
-                    other_box = Boundary(
-                            [[powerup.x - POWER_UP_MARGIN, powerup.y - POWER_UP_MARGIN],
-                             [powerup.x + POWER_UP_MARGIN, powerup.y - POWER_UP_MARGIN],
-                             [powerup.x + POWER_UP_MARGIN, powerup.y + POWER_UP_MARGIN],
-                             [powerup.x - POWER_UP_MARGIN, powerup.y + POWER_UP_MARGIN],
-                             [powerup.x - POWER_UP_MARGIN, powerup.y - POWER_UP_MARGIN]])
-                    if overlaps( other_box.path, hit_box.path ):
-                        print("Powerup")
-                        suitable = False
-
-                if suitable:
-                    break
-
-            a = random.randint(0,9)
-            if a < 3:
-                self.powerups.append( Coin( x, y ) )
-            elif a < 5:
-                self.powerups.append( Boost( x, y ) )
-            elif a < 7:
-                self.powerups.append( Brakes( x, y ) )
-            else:
-                self.powerups.append( Clear( x, y ) )
-
-            self.powerup_timer += POWER_UP_SPAWN
-            
-            if len(self.powerups) > 5:
-                self.powerup_timer += POWER_UP_SPAWN * 2
+            with profiler.section( "spawn" ):
+                self.spawn()
            
         for player in self.players:
             for powerup in list(self.powerups):
-                if powerup.hit_test( player.pos ):
+                if powerup.sweep_test( moved_from.get( player, player.pos ), player.pos ):
                     powerup.trigger( player, self )
                     self.powerups.remove( powerup )
+                    self.free_space.uncover( powerup.x, powerup.y )
 
             
 
 
-        if time_of_death and self.time - time_of_death > ROLL_ON_TIME:
+        # The match is over a while after all but one have crashed.
+        deaths.sort()
+        last = len( self.players ) - 2
+        if len( deaths ) > last and self.time - deaths[last] > ROLL_ON_TIME:
             for player in self.players:
                 if player.time_of_death:
-                    player.bonus += player.time_of_death * TIME_BONUS // 1000
+                    player.bonus += int( player.time_of_death * TIME_BONUS // 1000 )
                 else:
-                    player.bonus += self.time * TIME_BONUS // 1000
+                    player.bonus += int( self.time * TIME_BONUS // 1000 )
 
             return ScoreScreen( self.players )
 
 
+    def spawn( self ):
+        # When there's no room left the spawn is skipped, and tried
+        # again after the usual wait.
+        spot = self.free_space.sample( self.random )
+        if spot:
+            x, y = spot
+            a = self.random.randint(0,9)
+            if a < 3:
+                self.powerups.append( Coin( x, y ) )
+            elif a < 5:
+                self.powerups.append( Boost( x, y ) )
+            elif a < 7:
+                self.powerups.append( Brakes( x, y ) )
+            else:
+                self.powerups.append( Clear( x, y ) )
+            self.free_space.cover( x, y )
+
+        self.powerup_timer += POWER_UP_SPAWN
+        
+        if len(self.powerups) > 5:
+            self.powerup_timer += POWER_UP_SPAWN * 2
+
+
     def crash( self, player ):
         if player.time_of_death:
             return
@@ -655,68 +2261,31 @@ class Level():
             if opponent != player:
                 opponent.bonus += WINNER_BONUS
 
-        for i in range(0,10):
-            particle = Particle( player.pos, player.vel, pygame.Color( player.col ) )
-            particle.pos = player.pos
-            particle.vel = ( player.vel[0] + jitter() * self.speed * 5, 
-                             player.vel[1] + jitter() * self.speed * 5 )
-            self.particles.append( particle )
-        player.vel = [0,0]
+        self.particles.emit( player.pos, player.vel, player.col, EXPLOSION_PARTICLES, self.speed * 5, self.random )
+        player.vel[0] = player.vel[1] = 0
         player.time_of_death = self.time
+        # Dead trails fade out, so they come off the trail layer.
+        self.trails_dirty = True
 
 
     def handle(self, event):
 
-        if event.type == pygame.KEYDOWN:
-            for player in self.players:
-                if player.time_of_death:
-                    continue
-                vel = None
-                if event.key == player.keys[ Keys.UP ] and player.vel[0] != 0:
-                    vel = [0, -self.speed]
-                if event.key == player.keys[ Keys.DOWN ] and player.vel[0] != 0:
-                    vel = [0, +self.speed]
-                if event.key == player.keys[ Keys.RIGHT ]and player.vel[1] != 0:
-                    vel = [+self.speed, 0]
-                if event.key == player.keys[ Keys.LEFT ] and player.vel[1] != 0:
-                    vel = [-self.speed, 0]
-                if event.key == player.keys[ Keys.ACTIVATE ] and player.powerup:
-                    player.powerup.activate(True)
-                if vel:
-                    player.vel = vel
-                    player.path.append( player.pos )
-        if event.type == pygame.KEYUP:
-            for player in self.players:
-                if player.time_of_death:
-                    continue
-                if event.key == player.keys[ Keys.ACTIVATE ] and player.powerup:
-                    player.powerup.activate(False)
-                
-        if event.type == pygame.JOYBUTTONDOWN:
-            player = self.lookup[ event.instance_id ]
-            if event.button == 1 and player.powerup:
-                    player.powerup.activate(True)
-
-        if event.type == pygame.JOYBUTTONUP:
-            player = self.lookup[ event.instance_id ]
-            if event.button == 1 and player.powerup:
-                    player.powerup.activate(False)
+        control = self.controls.read( event )
+        if control is None:
+            return
+        p, action, pressed = control
+        player = self.players[p]
+        if player.time_of_death:
+            return
 
-        if event.type == pygame.JOYAXISMOTION:
-            vel = None
-            player = self.lookup[ event.instance_id ]
-            if not player.time_of_death:
-                if player.joystick.get_axis(0) < -DEADZONE and abs( player.joystick.get_axis(1) ) < DEADZONE and player.vel[0] != 0:
-                    vel = [0, +self.speed]
-                if player.joystick.get_axis(0) > DEADZONE and abs( player.joystick.get_axis(1) ) < DEADZONE and player.vel[0] != 0:
-                    vel = [0, -self.speed]
-                if player.joystick.get_axis(1) < -DEADZONE and abs( player.joystick.get_axis(0) ) < DEADZONE and player.vel[1] != 0:
-                    vel = [-self.speed, 0]
-                if player.joystick.get_axis(1) > DEADZONE and abs( player.joystick.get_axis(0) ) < DEADZONE and player.vel[1] != 0:
-                    vel = [+self.speed, 0]
-            if vel:
-                player.vel = vel
-                player.path.append( player.pos )
+        if action == Keys.ACTIVATE:
+            if player.powerup:
+                player.powerup.activate( pressed )
+        elif pressed:
+            # Only ever a quarter turn.
+            vel = self.turns[action]
+            if ( vel[0] and player.vel[1] != 0 ) or ( vel[1] and player.vel[0] != 0 ):
+                player.turn( vel )
 
 
 
@@ -727,76 +2296,116 @@ class TronGame():
     """ Our custom Tron Window."""
 
 
-    def __init__(self, fullscreen, rotate):
+    def __init__(self, fullscreen, rotate, vsync = False):
 
         """ Initializer """
 
         if fullscreen:
             info = pygame.display.Info()
-            self.screen = pygame.display.set_mode((0,0), pygame.FULLSCREEN | pygame.DOUBLEBUF)
             self.screen_width, self.screen_height = info.current_w, info.current_h
+            self.screen = self.open( ( 0, 0 ), pygame.FULLSCREEN | pygame.DOUBLEBUF, vsync )
         else:
             if rotate:
                 self.screen_width, self.screen_height = SCREEN_HEIGHT, SCREEN_WIDTH
             else:   
                 self.screen_width, self.screen_height = SCREEN_WIDTH, SCREEN_HEIGHT
-            self.screen = pygame.display.set_mode((self.screen_width, self.screen_height), pygame.DOUBLEBUF)
+            self.screen = self.open( ( self.screen_width, self.screen_height ), pygame.DOUBLEBUF, vsync )
 
+        # A rotated cabinet draws straight onto the screen too, the canvas
+        # turns game coordinates a quarter turn on the way.
         if rotate:
-            self.width = self.screen_height
-            self.height = self.screen_width
-            self.background = pygame.Surface( (self.screen_width, self.screen_height) )
-            self.background.fill(BLACK)
-            self.surface = pygame.Surface( (self.width, self.height), pygame.SRCALPHA)
+            self.surface = RotatedCanvas( self.screen )
         else: 
-            self.width = self.screen_width
-            self.height = self.screen_height
-            self.background = None
-            self.surface = self.screen
+            self.surface = Canvas( self.screen )
+        self.width = self.surface.width
+        self.height = self.surface.height
 
         self.rotate = rotate
 
         self.run = True
         
         self.level = HiscoreScreen()
+        self.drawn_level = None
+        self.accumulator = 0
         self.coin_button = False
         self.start_button = False
 
 
 
+    def open( self, size, flags, vsync ):
+        # Flips only wait for the display with SCALED's renderer, which
+        # not every driver has. It wants the real size, even fullscreen.
+        self.vsync = False
+        if vsync:
+            try:
+                screen = pygame.display.set_mode( ( self.screen_width, self.screen_height ), flags | pygame.SCALED, vsync = 1 )
+                self.vsync = True
+                return screen
+            except pygame.error as e:
+                print( "Pacing frames without vsync, it isn't available:", e, file = sys.stderr )
+        return pygame.display.set_mode( size, flags )
+
+    def idle( self ):
+        """True when what's on screen won't change until there's input."""
+        if self.level is not self.drawn_level:
+            return False
+        idle = getattr( self.level, "idle", None )
+        return bool( idle and idle() )
+
     def draw(self):
 
         """ Draw everything """
 
-        self.surface.fill(BLACK)
+        # Only what was drawn last frame gets cleared, and only what
+        # changed gets pushed to the display.
+        self.surface.begin()
+
+        if self.level is not self.drawn_level:
+            self.surface.reset()
+            self.drawn_level = self.level
 
         if self.level:
             self.level.draw( self.width, self.height, self.surface )
 
-        if self.rotate:
-            self.screen.blit( self.background, (0, 0))
-            self.screen.blit( pygame.transform.rotate( self.surface, -90 ), (0, 0))
+        profiler.draw_hud( self.surface, self.width, self.height )
         
-        pygame.display.flip()
+        with profiler.section( "flip" ):
+            rects = self.surface.end()
+            if rects is None:
+                pygame.display.flip()
+            else:
+                pygame.display.update( rects )
 
     def update(self, delta_time ):
         
         """ Update state """
 
-        if self.level:
-            new_level = self.level.update( delta_time, self.width, self.height )
-            if new_level:
-                self.level = new_level
+        # The simulation always advances in SIM_TICK steps, however long
+        # the frame took, so gameplay doesn't depend on the frame rate. A
+        # really long stall is cut short rather than caught up on.
+        self.accumulator += min( delta_time, MAX_FRAME_TIME )
+
+        # One deadline for the bots, shared by every tick this frame runs.
+        deadline = time.perf_counter() + BOT_FRAME_BUDGET / 1000
+        while self.accumulator >= SIM_TICK:
+            self.accumulator -= SIM_TICK
+            if isinstance( self.level, Level ):
+                self.level.deadline = deadline
+            if self.level:
+                new_level = self.level.update( SIM_TICK, self.width, self.height )
+                if new_level:
+                    recorder.switch( self.level, new_level )
+                    self.level = new_level
 
 
-    def handle(self):
+    def handle(self, events = None):
 
-        for event in pygame.event.get():
+        for event in pygame.event.get() if events is None else events:
             if event.type == pygame.QUIT: 
-                self.run = False
+                self.quit()
             if event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_q:
-                    self.run = False
+                    self.quit()
             if event.type == pygame.JOYBUTTONDOWN:
                 if event.button == 9:
                     self.start_button = True
@@ -808,25 +2417,708 @@ class TronGame():
                 if event.button == 8:
                     self.coin_button = False
             if self.level:
+                recorder.event( self.level, event )
                 self.level.handle( event )
 
         if self.coin_button and self.start_button:
-            self.run = False
+            self.quit()
+
+    def quit(self):
+
+        """ Stop after this frame. Whatever the rest of the events in it
+        save or record still gets written, main() closing the files once
+        the loop is done. """
+
+        self.run = False
+
+class ScriptedInput():
+
+    """Key presses for a headless match.
+
+    The script is a list of [tick, player, key, down] entries, key being a
+    Keys name such as "UP". They are turned into the same KEYDOWN/KEYUP
+    events the live game hands to Level.handle."""
+
+    def __init__( self, script ):
+        self.script = collections.defaultdict(list)
+        for tick, player, key, down in script:
+            self.script[tick].append( ( player, Keys[key], down ) )
+
+    def events( self, tick, level ):
+        for player, key, down in self.script.get( tick, () ):
+            yield pygame.event.Event( pygame.KEYDOWN if down else pygame.KEYUP, key = level.players[player].keys[key] )
+
+
+class RandomInput():
 
-def main( fullscreen, rotate ):
+    """Presses a random direction for a random player every so often."""
+
+    def __init__( self, rate = 0.02, seed = None ):
+        self.rate = rate
+        self.random = random.Random( seed )
+
+    def events( self, tick, level ):
+        players = [ player for player in level.players if not player.bot and player.keys is not NO_KEYS ]
+        if players and self.random.random() < self.rate:
+            player = self.random.choice( players )
+            key = self.random.choice( [ Keys.UP, Keys.DOWN, Keys.LEFT, Keys.RIGHT ] )
+            yield pygame.event.Event( pygame.KEYDOWN, key = player.keys[key] )
+
+
+class Recorder():
+
+    """Writes the input of every match played to a binary log.
+
+    The file starts with a header, then each match is a record with its
+    seed, screen size, number of players and joysticks, the events Level.handle saw tagged
+    with the tick they came before, and an end record with the scores.
+    Writes go through a large buffer and are only flushed on close."""
+
+    HEADER = struct.Struct( "<4sd" )
+    MAGIC = b"TRN3"
+    MATCH = struct.Struct( "<cqHHBB" )
+    JOYSTICK = struct.Struct( "<i" )
+    KEY = struct.Struct( "<cIi" )
+    BUTTON = struct.Struct( "<cIiB" )
+    AXIS = struct.Struct( "<cIiBf" )
+    END = struct.Struct( "<cIB" )
+    SCORE = struct.Struct( "<d" )
+
+    def __init__( self, filename ):
+        self.file = open( filename, 'wb', buffering = RECORD_BUFFER )
+        self.file.write( self.HEADER.pack( self.MAGIC, SIM_TICK ) )
+        self.level = None
+
+    def switch( self, old, new ):
+        # A networked match is recorded like any other, from the input
+        # both cabinets played through its level.
+        if isinstance( old, NetMatch ):
+            old = old.level
+        if isinstance( new, NetMatch ):
+            new = new.level
+        if old is self.level:
+            self.end()
+        if isinstance( new, Level ):
+            self.level = new
+            self.file.write( self.MATCH.pack( b"M", new.seed, int( new.width ), int( new.height ), len( new.players ), len( new.lookup ) ) )
+            for instance_id in new.lookup:
+                self.file.write( self.JOYSTICK.pack( instance_id ) )
+
+    def event( self, level, event ):
+        if level is not self.level:
+            return
+        tick = level.ticks
+        if event.type == pygame.KEYDOWN:
+            self.file.write( self.KEY.pack( b"K", tick, event.key ) )
+        elif event.type == pygame.KEYUP:
+            self.file.write( self.KEY.pack( b"k", tick, event.key ) )
+        elif event.type == pygame.JOYBUTTONDOWN:
+            self.file.write( self.BUTTON.pack( b"B", tick, event.instance_id, event.button ) )
+        elif event.type == pygame.JOYBUTTONUP:
+            self.file.write( self.BUTTON.pack( b"b", tick, event.instance_id, event.button ) )
+        elif event.type == pygame.JOYAXISMOTION and event.instance_id in level.lookup:
+            self.file.write( self.AXIS.pack( b"A", tick, event.instance_id, event.axis, event.value ) )
+
+    def end( self ):
+        level = self.level
+        self.level = None
+        self.file.write( self.END.pack( b"E", level.ticks, len( level.players ) ) )
+        for player in level.players:
+            self.file.write( self.SCORE.pack( player.score + player.bonus ) )
+
+    def close( self ):
+        if self.level:
+            self.end()
+        self.file.close()
+
+
+class NullRecorder():
+
+    """Stands in for Recorder when nothing is being recorded."""
+
+    def switch( self, old, new ):
+        pass
+
+    def event( self, level, event ):
+        pass
+
+    def close( self ):
+        pass
+
+
+recorder = NullRecorder()
+
+
+def read_recording( filename ):
+
+    """ The matches in a file written by Recorder, as dicts. If the game
+    never got to close the file, the last match has no "end". """
+
+    with open( filename, 'rb' ) as f:
+        data = f.read()
+
+    magic, tick = Recorder.HEADER.unpack_from( data )
+    if magic != Recorder.MAGIC:
+        raise ValueError( filename + " is not a Tron recording" )
+    offset = Recorder.HEADER.size
+
+    events = {
+        b"K": ( Recorder.KEY, pygame.KEYDOWN ),
+        b"k": ( Recorder.KEY, pygame.KEYUP ),
+        b"B": ( Recorder.BUTTON, pygame.JOYBUTTONDOWN ),
+        b"b": ( Recorder.BUTTON, pygame.JOYBUTTONUP ),
+        b"A": ( Recorder.AXIS, pygame.JOYAXISMOTION ),
+    }
+
+    matches = []
+    while offset < len( data ):
+        tag = data[offset:offset + 1]
+        if tag == b"M":
+            tag, seed, width, height, players, count = Recorder.MATCH.unpack_from( data, offset )
+            offset += Recorder.MATCH.size
+            joysticks = [ Recorder.JOYSTICK.unpack_from( data, offset + i * Recorder.JOYSTICK.size )[0] for i in range( count ) ]
+            offset += count * Recorder.JOYSTICK.size
+            matches.append( { "seed": seed, "width": width, "height": height, "tick": tick, "players": players,
+                              "joysticks": joysticks, "events": collections.defaultdict(list), "end": None } )
+        elif tag == b"E":
+            tag, ticks, count = Recorder.END.unpack_from( data, offset )
+            offset += Recorder.END.size
+            scores = [ Recorder.SCORE.unpack_from( data, offset + i * Recorder.SCORE.size )[0] for i in range( count ) ]
+            offset += count * Recorder.SCORE.size
+            matches[-1]["end"] = { "ticks": ticks, "scores": scores }
+        elif tag in events:
+            layout, kind = events[tag]
+            fields = layout.unpack_from( data, offset )
+            offset += layout.size
+            matches[-1]["events"][ fields[1] ].append( ( kind, fields[2:] ) )
+        else:
+            raise ValueError( "bad record %r at %d in %s" % ( tag, offset, filename ) )
+    return matches
+
+
+class ReplayJoystick():
+
+    """Just enough of a pygame joystick to replay a match with."""
+
+    def __init__( self, instance_id ):
+        self.instance_id = instance_id
+
+    def get_instance_id( self ):
+        return self.instance_id
+
+
+class RecordedInput():
+
+    """Plays back the events of a match read by read_recording."""
+
+    def __init__( self, match ):
+        self.match = match
+
+    def events( self, tick, level ):
+        for kind, fields in self.match["events"].get( tick, () ):
+            if kind in ( pygame.KEYDOWN, pygame.KEYUP ):
+                yield pygame.event.Event( kind, key = fields[0] )
+            elif kind == pygame.JOYAXISMOTION:
+                yield pygame.event.Event( kind, instance_id = fields[0], axis = fields[1], value = fields[2] )
+            else:
+                yield pygame.event.Event( kind, instance_id = fields[0], button = fields[1] )
+
+
+def replay( match ):
+
+    """ Play a recorded match again headless, see simulate. """
+
+    # A match that was still going when the game stopped ends where it did.
+    max_ticks = match["end"]["ticks"] if match["end"] else SIM_MAX_TICKS
+    joysticks = [ ReplayJoystick( instance_id ) for instance_id in match["joysticks"] ]
+    return simulate( RecordedInput( match ), match["width"], match["height"], match["tick"], max_ticks, match["seed"], joysticks, match["players"] )
+
+
+def simulate( inputs = None, width = SCREEN_WIDTH, height = SCREEN_HEIGHT, tick = SIM_TICK, max_ticks = SIM_MAX_TICKS, seed = None, joysticks = (), players = 2, bots = () ):
+
+    """ Play a match without a display, stepping the level tick ms at a time.
+
+    Returns a dict describing how the match went. """
+
+    level = Level( width, height, joysticks, seed, players, bots )
+
+    ticks = 0
+    finished = False
+    while ticks < max_ticks and not finished:
+        if inputs:
+            for event in inputs.events( ticks, level ):
+                level.handle( event )
+        finished = level.update( tick, width, height ) is not None
+        ticks += 1
+
+    return summary( level, ticks, finished )
+
+
+def summary( level, ticks, finished ):
+    alive = [ player.name for player in level.players if not player.time_of_death ]
+
+    return {
+        "seed": level.seed,
+        "ticks": ticks,
+        "time": level.time,
+        "finished": finished,
+        "winner": alive[0] if finished and len( alive ) == 1 else None,
+        "players": [ { "name": player.name,
+                       "score": player.score + player.bonus,
+                       "time_of_death": player.time_of_death } for player in level.players ]
+    }
+
+
+def net_controls():
+    """Controls where any player's keys and any joystick steer this
+    cabinet's seat in a networked match."""
+    return Controls( bindings, [ ( 0, keys ) for keys in bindings.keys ],
+                     { joystick.get_instance_id() : 0 for joystick in joysticks } )
+
+def net_action( control ):
+    """The byte a control adds to this tick's input: a Keys direction plus
+    one in the low three bits, NET_PRESS and NET_RELEASE for activate."""
+    if control is None:
+        return 0
+    p, action, pressed = control
+    if action == Keys.ACTIVATE:
+        return NET_PRESS if pressed else NET_RELEASE
+    return action + 1 if pressed else 0
+
+def merge_action( action, new ):
+    # The last turn in a tick wins, presses and releases add up.
+    if new & NET_TURN:
+        action = action & ~NET_TURN | new & NET_TURN
+    return action | new & ( NET_PRESS | NET_RELEASE )
+
+def action_events( player, action ):
+    """The key events that play action for player through Level.handle."""
+    if action & NET_TURN:
+        yield pygame.event.Event( pygame.KEYDOWN, key = player.keys[ ( action & NET_TURN ) - 1 ] )
+    if action & NET_PRESS:
+        yield pygame.event.Event( pygame.KEYDOWN, key = player.keys[ Keys.ACTIVATE ] )
+    if action & NET_RELEASE:
+        yield pygame.event.Event( pygame.KEYUP, key = player.keys[ Keys.ACTIVATE ] )
+
+
+class NetLink():
+
+    """A UDP socket to the other cabinet.
+
+    To try netplay out on one machine, the link can lose a fraction of
+    the packets it sends and hold the rest back for latency ms, give or
+    take half of it, so they also arrive out of order."""
+
+    def __init__( self, port, remote = None, loss = 0.0, latency = 0.0, seed = None ):
+        self.socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        self.socket.bind( ( "", port ) )
+        self.socket.setblocking( False )
+        self.remote = remote
+        self.loss = loss
+        self.latency = latency / 1000
+        self.random = random.Random( seed )
+        self.held = []
+        self.sent = 0
+
+    def send( self, data ):
+        if self.remote is None or self.random.random() < self.loss:
+            return
+        if self.latency:
+            due = time.perf_counter() + self.latency * ( 0.5 + self.random.random() )
+            self.sent += 1
+            heapq.heappush( self.held, ( due, self.sent, data ) )
+        else:
+            self.socket.sendto( data, self.remote )
+
+    def receive( self ):
+        """Packets that came in since last time, with their sender."""
+        now = time.perf_counter()
+        while self.held and self.held[0][0] <= now:
+            self.socket.sendto( heapq.heappop( self.held )[2], self.remote )
+        packets = []
+        while True:
+            try:
+                packets.append( self.socket.recvfrom( NET_PACKET ) )
+            except OSError:
+                # Nothing left, or an ICMP error from a peer that isn't
+                # listening yet, which some platforms report here.
+                return packets
+
+    def wait( self, timeout ):
+        select.select( [ self.socket ], [], [], timeout )
+
+    def close( self ):
+        self.socket.close()
+
+
+class NetSession():
+
+    """Two cabinets playing the same matches in lockstep over UDP, the host
+    in the first seat. Only input goes between them, see net_action."""
+
+    MAGIC = b"TRNN"
+    HEADER = struct.Struct( "<4sc" )
+    # Seed, input delay in ticks and the host's screen size.
+    START = struct.Struct( "<qBHH" )
+    # Match, ticks of the other end's input received, first tick of the
+    # input that follows, and the tick and value of the latest checksum.
+    INPUT = struct.Struct( "<IIIII" )
+
+    def __init__( self, link, host, seed = None, delay = NET_DELAY ):
+        self.link = link
+        self.host = host
+        self.seat = 0 if host else 1
+        self.seed = random.getrandbits( 63 ) if seed is None else seed
+        # Input goes down delay ticks ahead of its tick, hiding that much
+        # latency. A tick waits for the other end's input if it's late.
+        self.delay = delay
+        self.started = False
+        self.calls = 0
+        self.outboxes = {}
+        self.inboxes = {}
+        self.acks = {}
+        self.peer_match = 0
+        self.size = None
+        self.checks = {}
+        self.peer_checks = {}
+        self.latest = {}
+        self.desync = None
+
+    def packet( self, tag, body = b"" ):
+        self.link.send( self.HEADER.pack( self.MAGIC, tag ) + body )
+
+    def box( self, boxes, match ):
+        # Nobody has input for the first delay ticks of a match.
+        if match not in boxes:
+            boxes[match] = bytearray( self.delay )
+            for old in [ m for m in boxes if m < match - 1 ]:
+                del boxes[old]
+        return boxes[match]
+
+    def outbox( self, match ):
+        return self.box( self.outboxes, match )
+
+    def inbox( self, match ):
+        return self.box( self.inboxes, match )
+
+    def connect( self ):
+        """Whether the other cabinet is there. The one joining says hello
+        every so often until the host answers with the seed and delay."""
+        if not self.host and not self.started and self.calls % NET_HELLO_TICKS == 0:
+            self.packet( b"H" )
+        self.calls += 1
+        self.receive()
+        return self.started
+
+    def receive( self ):
+        for data, address in self.link.receive():
+            if len( data ) < self.HEADER.size:
+                continue
+            magic, tag = self.HEADER.unpack_from( data )
+            if magic != self.MAGIC:
+                continue
+            body = data[ self.HEADER.size: ]
+            if tag == b"H" and self.host:
+                # Answered every time, in case the answer was lost.
+                self.link.remote = address
+                self.started = True
+                self.packet( b"S", self.START.pack( self.seed, self.delay, *self.size ) )
+            elif tag == b"S" and not self.host and not self.started:
+                self.seed, self.delay, width, height = self.START.unpack_from( body )
+                self.size = ( width, height )
+                self.started = True
+            elif tag == b"I" and address == self.link.remote:
+                match, ack, first, tick, checksum = self.INPUT.unpack_from( body )
+                actions = body[ self.INPUT.size: ]
+                if tick:
+                    self.peer_checks[ ( match, tick ) ] = checksum
+                    self.compare()
+                self.acks[match] = max( self.acks.get( match, 0 ), ack )
+                self.peer_match = max( self.peer_match, match )
+                if match < self.peer_match - 1:
+                    continue
+                inbox = self.inbox( match )
+                if first <= len( inbox ) < first + len( actions ):
+                    inbox += actions[ len( inbox ) - first: ]
+
+    def send( self, match ):
+        # Everything the other end hasn't said it has, up to NET_WINDOW
+        # ticks, so a lost packet is made up for by the next.
+        outbox = self.outbox( match )
+        start = self.acks.get( match, 0 )
+        tick, checksum = self.latest.get( match, ( 0, 0 ) )
+        body = self.INPUT.pack( match, len( self.inbox( match ) ), start, tick, checksum ) + outbox[ start : start + NET_WINDOW ]
+        self.packet( b"I", body )
+
+    def check( self, match, tick, checksum ):
+        """Note this end's checksum of match at tick."""
+        self.checks[ ( match, tick ) ] = checksum
+        self.latest[match] = ( tick, checksum )
+        for old in [ key for key in self.checks if key[0] < match - 1 ]:
+            del self.checks[old]
+        self.latest.pop( match - 2, None )
+        self.compare()
+
+    def compare( self ):
+        # Levels that checksum differently have gone out of step.
+        for key in [ key for key in self.peer_checks if key in self.checks ]:
+            if self.peer_checks.pop( key ) != self.checks[key] and self.desync is None:
+                self.desync = key
+                print( "Out of step with the other cabinet in match %d by tick %d" % key, file = sys.stderr )
+
+    def finish( self, match, timeout = 2.0 ):
+        """Keep answering until the other end has all of this end's input
+        for match, or timeout seconds have gone."""
+        end = time.perf_counter() + timeout
+        while self.acks.get( match, 0 ) < len( self.outbox( match ) ) - self.delay and time.perf_counter() < end:
+            self.send( match )
+            self.link.wait( SIM_TICK / 1000 )
+            self.receive()
+
+
+class NetLobby():
+
+    """Waits for the other cabinet, then starts the first match."""
+
+    def __init__( self, session ):
+        self.session = session
+        self.message = "WAITING" if session.host else "JOINING"
+
+    def draw( self, width, height, surface ):
+        write( surface, width // 2, height // 2, self.message, True )
+
+    def handle( self, event ):
+        pass
+
+    def update( self, delta_time, width, height ):
+        session = self.session
+        if session.host:
+            session.size = ( int( width ), int( height ) )
+        if session.connect():
+            # The host's field has to fit on this screen.
+            if session.size[0] > width or session.size[1] > height:
+                self.message = "SCREEN TOO SMALL"
+                return None
+            return NetMatch( session, 0 )
+
+
+class NetMatch():
+
+    """A Level played in step with the other cabinet, see NetSession.
+
+    Local input isn't handed to the level. It is put in the outbox for
+    delay ticks ahead, and each tick both seats' input for it is played
+    through Level.handle in seat order, the same on both cabinets. When
+    the match is over the next one starts with the next seed. The level is
+    the host's size whatever the size of this screen."""
+
+    def __init__( self, session, match ):
+        self.session = session
+        self.match = match
+        self.width, self.height = session.size
+        self.level = Level( self.width, self.height, seed = ( session.seed + match ) % ( 1 << 63 ) )
+        self.outbox = session.outbox( match )
+        self.inbox = session.inbox( match )
+        self.action = 0
+        self.owed = 0
+        self.controls = net_controls()
+
+    def draw( self, width, height, surface ):
+        self.level.draw( self.width, self.height, surface )
+        if self.session.desync:
+            write( surface, self.width // 2, self.height // 2, "OUT OF STEP", True )
+
+    def handle( self, event ):
+        self.action = merge_action( self.action, net_action( self.controls.read( event ) ) )
+
+    def update( self, delta_time, width, height ):
+        session = self.session
+        session.receive()
+        # Ticks the other cabinet held up are caught up on, but only so
+        # many, like a long frame.
+        self.owed = min( self.owed + 1, MAX_FRAME_TIME // SIM_TICK )
+        result = None
+        while self.owed and not result:
+            tick = self.level.ticks
+            while len( self.outbox ) <= tick + session.delay:
+                self.outbox.append( self.action )
+                self.action = 0
+            if len( self.inbox ) <= tick:
+                break
+            seats = { session.seat : self.outbox[tick], 1 - session.seat : self.inbox[tick] }
+            for seat in sorted( seats ):
+                for event in action_events( self.level.players[seat], seats[seat] ):
+                    recorder.event( self.level, event )
+                    self.level.handle( event )
+            result = self.level.update( delta_time, self.width, self.height )
+            self.owed -= 1
+            if self.level.ticks % NET_CHECK_TICKS == 0:
+                session.check( self.match, self.level.ticks, level_checksum( self.level ) )
+
+        session.send( self.match )
+        # The other cabinet may still need the end of the last match.
+        if session.peer_match < self.match:
+            session.send( session.peer_match )
+        if result:
+            return NetMatch( session, self.match + 1 )
+
+    def stalled( self ):
+        """Whether the next tick is waiting on the other cabinet."""
+        return len( self.inbox ) <= self.level.ticks
+
+
+def level_checksum( level ):
+    """A cheap fingerprint of where everyone is and how they're doing."""
+    checksum = zlib.crc32( struct.pack( "<Id", level.ticks, level.time ) )
+    for player in level.players:
+        checksum = zlib.crc32( struct.pack( "<6dI", player.pos[0], player.pos[1], player.vel[0], player.vel[1],
+                                            player.score, player.time_of_death, len( player.path ) ), checksum )
+    return checksum
+
+
+def netplay( session, inputs = None, matches = 1, width = SCREEN_WIDTH, height = SCREEN_HEIGHT ):
+
+    """ Play matches against another cabinet without a display, taking
+    this cabinet's input from inputs like simulate. Returns a list of
+    dicts describing how each match went. """
+
+    screen = NetLobby( session )
+    results = []
+    while len( results ) < matches:
+        if inputs and isinstance( screen, NetMatch ):
+            for event in inputs.events( screen.level.ticks, screen.level ):
+                screen.handle( event )
+        new = screen.update( SIM_TICK, width, height )
+        if new:
+            if isinstance( screen, NetMatch ):
+                results.append( summary( screen.level, screen.level.ticks, True ) )
+                results[-1]["desync"] = session.desync
+            screen = new
+        elif not isinstance( screen, NetMatch ) or screen.stalled():
+            session.link.wait( SIM_TICK / 1000 )
+    session.finish( len( results ) - 1 )
+    return results
+
+
+def refresh_rate():
+    """The display's refresh rate, where pygame can tell."""
+    get = getattr( pygame.display, "get_current_refresh_rate", None )
+    return ( get and get() ) or FRAME_RATE
+
+
+class FrameScheduler():
+
+    """Paces the main loop at rate frames a second, or not at all for 0.
+
+    wait() goes at the end of a frame and sleeps until the next is due,
+    spinning for the last FRAME_SPIN ms as sleep() can overshoot. Input is
+    read straight after, so it's as fresh as it was without the wait. A frame that
+    runs late starts the schedule again rather than hurrying the next.
+
+    idle() is for when nothing on screen moves: it sleeps until there's
+    an event or IDLE_WAKE ms have gone, and returns any events."""
+
+    def __init__( self, rate ):
+        self.period = 1.0 / rate if rate else 0
+        self.due = time.perf_counter()
+
+    def wait( self ):
+        if not self.period:
+            return
+        self.due += self.period
+        now = time.perf_counter()
+        if now >= self.due:
+            self.due = now
+            return
+        if self.due - now > FRAME_SPIN / 1000:
+            time.sleep( self.due - now - FRAME_SPIN / 1000 )
+        while time.perf_counter() < self.due:
+            pass
+
+    def idle( self ):
+        event = pygame.event.wait( IDLE_WAKE )
+        self.due = time.perf_counter()
+        if event.type == pygame.NOEVENT:
+            return []
+        return [ event ] + pygame.event.get()
+
+
+def main( fullscreen, rotate, asset_report = False, profile = None, record = None, bot_levels = (), session = None, profile_startup = False, rate = None, vsync = False ):
 
     """ Main function """
 
-    tron = TronGame( fullscreen, rotate )
+    global profiler, recorder, bots
+
+    startup = StartupProfile()
+    startup.mark( "import" )
+
+    bots = list( bot_levels )
+
+    if profile:
+        profiler = profile
+    if record:
+        recorder = Recorder( record )
+
+    # Neither needs the display, so the scores and the image files are
+    # read while it comes up.
+    tasks = [ Task( "hiscores", highscores.leaderboard ), Task( "asset files", find_assets ) ]
 
-    ticks = pygame.time.get_ticks()
+    init()
+    startup.mark( "init" )
+
+    tron = TronGame( fullscreen, rotate, vsync )
+    if session:
+        tron.level = NetLobby( session )
+    startup.mark( "window" )
+
+    load_assets( tasks[1].result() )
+    startup.mark( "assets" )
+    if asset_report:
+        for line in assets.report():
+            print( line )
+
+    # With vsync the flip keeps time, the cap a little above the display
+    # only comes in where the driver doesn't really wait for it.
+    if rate is None:
+        rate = refresh_rate() * VSYNC_HEADROOM if tron.vsync else FRAME_RATE
+    frames = FrameScheduler( rate )
+
+    ticks = time.perf_counter()
 
     while tron.run:
-        now = pygame.time.get_ticks()
-        tron.handle()
-        tron.update( now - ticks )
-        ticks = now
-        tron.draw()
+        events = None
+        if tron.idle():
+            # Nothing to draw until something happens, and the time spent
+            # waiting for it doesn't count towards the next tick.
+            events = frames.idle()
+            ticks = time.perf_counter()
+        start = time.perf_counter()
+        with profiler.section( "handle" ):
+            tron.handle( events )
+        with profiler.section( "update" ):
+            tron.update( ( start - ticks ) * 1000 )
+        ticks = start
+        with profiler.section( "draw" ):
+            tron.draw()
+        profiler.add( "total", ( time.perf_counter() - start ) * 1000 )
+        profiler.end_frame()
+
+        if startup:
+            startup.mark( "first frame" )
+            if profile_startup:
+                for line in startup.report( tasks ):
+                    print( line )
+            startup = None
+
+        frames.wait()
+
+    writer.close()
+    recorder.close()
+    profiler.close()
+    if profile:
+        print( "%-10s %7s %7s %7s" % ( "ms", "p50", "p95", "p99" ) )
+        for line in profiler.report():
+            print( line )
 
 
 
@@ -835,5 +3127,75 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser( description = 'Tron.' )
     parser.add_argument( '--fullscreen', action='store_true')
     parser.add_argument( '--rotate', action='store_true')
+    parser.add_argument( '--fps', type=int, help='frames a second to draw, 0 for as many as possible (default %d, or the display\'s with --vsync)' % FRAME_RATE )
+    parser.add_argument( '--vsync', action='store_true', help='wait for the display to flip, where the driver can')
+    parser.add_argument( '--asset-report', action='store_true', help='print load time and memory use of each image')
+    parser.add_argument( '--build-assets', action='store_true', help='draw the sprite atlas for this cabinet into the cache and stop')
+    parser.add_argument( '--profile', action='store_true', help='time each frame and print p50/p95/p99 per phase on exit')
+    parser.add_argument( '--profile-hud', action='store_true', help='show frame timings on screen, implies --profile')
+    parser.add_argument( '--profile-trace', metavar='FILE', help='write per-frame timings to a CSV (or .json) file, implies --profile')
+    parser.add_argument( '--profile-startup', action='store_true', help='print how long each phase of starting up took, up to the first frame')
+    parser.add_argument( '--headless', action='store_true', help='simulate matches without a display')
+    parser.add_argument( '--matches', type=int, default=1, help='headless matches to play')
+    parser.add_argument( '--seed', type=int, default=None, help='seed for the first headless match')
+    parser.add_argument( '--tick', type=float, default=SIM_TICK, help='headless tick length in ms')
+    parser.add_argument( '--max-ticks', type=int, default=SIM_MAX_TICKS, help='give up on a headless match after this many ticks')
+    parser.add_argument( '--players', type=int, default=2, choices=range( 2, len( PLAYERS ) + 1 ), help='players in each headless match')
+    parser.add_argument( '--script', help='JSON file of [tick, player, key, down] entries to play instead of random input')
+    parser.add_argument( '--record', metavar='FILE', help='record the input of every match played to FILE')
+    parser.add_argument( '--replay', metavar='FILE', help='replay the matches recorded in FILE headless')
+    parser.add_argument( '--bot', choices=sorted( BOT_LEVELS ), help='let bots play the last seats with keys at this difficulty')
+    parser.add_argument( '--bots', type=int, default=1, choices=range( 1, sum( keys is not NO_KEYS for name, col, keys in PLAYERS ) + 1 ), help='how many seats --bot takes')
+    parser.add_argument( '--bindings', metavar='FILE', help='JSON file of keys and joystick controls to play with, see Bindings.load')
+    parser.add_argument( '--host', type=int, metavar='PORT', help='play against another cabinet that joins on PORT')
+    parser.add_argument( '--join', metavar='HOST:PORT', help='play against the cabinet hosting at HOST:PORT')
+    parser.add_argument( '--net-delay', type=int, default=NET_DELAY, choices=range( 0, NET_WINDOW // 2 ), metavar='TICKS', help='ticks local input is held back to hide latency')
+    parser.add_argument( '--net-loss', type=float, default=0.0, help='fraction of packets to drop, to test netplay')
+    parser.add_argument( '--net-latency', type=float, default=0.0, metavar='MS', help='delay every packet by about this much, to test netplay')
     args = parser.parse_args()
-    main(args.fullscreen,args.rotate)
+    if args.bindings:
+        try:
+            bindings = Bindings.load( args.bindings )
+        except ( OSError, ValueError ) as e:
+            parser.error( str( e ) )
+    bot_levels = [ args.bot ] * args.bots if args.bot else []
+    session = None
+    if args.host is not None or args.join:
+        if args.join:
+            host, port = args.join.rsplit( ":", 1 )
+            link = NetLink( 0, ( socket.gethostbyname( host ), int( port ) ), args.net_loss, args.net_latency )
+        else:
+            link = NetLink( args.host, None, args.net_loss, args.net_latency )
+        session = NetSession( link, args.host is not None, args.seed, args.net_delay )
+    if args.build_assets:
+        texture, index = sprite_files()
+        build_sprites( texture, index )
+        print( "wrote", texture )
+    elif args.replay:
+        for match in read_recording( args.replay ):
+            result = replay( match )
+            result["recorded"] = match["end"]
+            print( json.dumps( result ) )
+    elif args.headless and session:
+        inputs = RandomInput( seed = args.seed )
+        for result in netplay( session, inputs, args.matches ):
+            print( json.dumps( result ) )
+    elif args.headless:
+        # Live play leaves out bots there are no seats for; here every
+        # match has the same players, so it's better said up front.
+        seats = sum( keys is not NO_KEYS for name, col, keys in PLAYERS[ : args.players ] )
+        if len( bot_levels ) > seats:
+            parser.error( "--bots %d is more than the %d seats with keys in a %d player match" % ( args.bots, seats, args.players ) )
+        script = None
+        if args.script:
+            with open( args.script, 'r' ) as f:
+                script = json.load( f )
+        for match in range( args.matches ):
+            seed = None if args.seed is None else args.seed + match
+            inputs = ScriptedInput( script ) if script is not None else RandomInput( seed = seed )
+            print( json.dumps( simulate( inputs, tick = args.tick, max_ticks = args.max_ticks, seed = seed, players = args.players, bots = bot_levels ) ) )
+    else:
+        profile = None
+        if args.profile or args.profile_hud or args.profile_trace:
+            profile = Profiler( args.profile_trace, args.profile_hud )
+        main(args.fullscreen,args.rotate,args.asset_report,profile,args.record,bot_levels,session,args.profile_startup,args.fps,args.vsync)